@@ -1,47 +1,96 @@
 from flask import Flask
 from flask_cors import CORS
-from database import db
+from database import db, engine_options, database_url, REPLICA_BIND
 import os
 
-# Initialize Flask app
-app = Flask(__name__)
-CORS(app, supports_credentials=True)
 
-# セッション管理の設定
-app.secret_key = os.getenv('SECRET_KEY', 'tmcit2025-secret-key-change-in-production')
-app.config['SESSION_COOKIE_SECURE'] = False  # HTTPSでない場合はFalse
-app.config['SESSION_COOKIE_HTTPONLY'] = True
-app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'
+def create_app(config=None):
+    """Create the Flask app; config overrides the settings read from the environment.
 
-# Create database directory if it doesn't exist
-os.makedirs('/data', exist_ok=True)
+    No database or filesystem work happens here, so every gunicorn worker
+    starts quickly. Tables and migrations are applied once per deployment
+    with `flask --app app:create_app init-db` (or DB_AUTO_MIGRATE=true).
+    No background threads are started either: queued emails are sent by
+    `flask --app app:create_app email-worker`.
+    """
+    app = Flask(__name__)
+    CORS(app, supports_credentials=True)
 
-# Database configuration
-app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL', 'sqlite:////data/attendance.db')
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    # セッション管理の設定
+    app.secret_key = os.getenv('SECRET_KEY', 'tmcit2025-secret-key-change-in-production')
+    app.config['SESSION_COOKIE_SECURE'] = False  # HTTPSでない場合はFalse
+    app.config['SESSION_COOKIE_HTTPONLY'] = True
+    app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'
 
-# Initialize database with app
-db.init_app(app)
+    # Database configuration (SQLite file by default, or PostgreSQL)
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL', 'sqlite:////data/attendance.db')
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
-# Import models after db initialization
-from models import User, Attendance
+    # Optional read replica for the read-only list and report endpoints
+    app.config['DATABASE_REPLICA_URL'] = os.getenv('DATABASE_REPLICA_URL')
 
-# Import routes after models
-from routes import register_routes
-from auth import register_auth_routes
+    # 起動時にテーブル作成・マイグレーションを行うか（通常は init-db コマンドで一度だけ実行）
+    app.config['DB_AUTO_MIGRATE'] = os.getenv('DB_AUTO_MIGRATE', 'false').lower() == 'true'
 
-# Create tables and ensure database is initialized
-with app.app_context():
-    try:
-        # This will create the database file if it doesn't exist
-        db.create_all()
-        print("Database tables created successfully")
-    except Exception as e:
-        print(f"Error creating database tables: {e}")
+    if config:
+        app.config.update(config)
+
+    app.config['SQLALCHEMY_DATABASE_URI'] = database_url(app.config['SQLALCHEMY_DATABASE_URI'])
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engine_options(app.config['SQLALCHEMY_DATABASE_URI']))
+    if app.config['DATABASE_REPLICA_URL']:
+        replica_url = database_url(app.config['DATABASE_REPLICA_URL'])
+        app.config['SQLALCHEMY_BINDS'] = {REPLICA_BIND: {'url': replica_url, **engine_options(replica_url)}}
+
+    # Initialize database with app
+    db.init_app(app)
+
+    # Import routes after db initialization
+    from routes import register_routes
+    from auth import register_auth_routes
+    from reports import register_report_routes
+    from exports import register_export_routes
+    from metrics import register_metrics
+    from attendance_events import register_event_routes
+    from compression import register_compression
+    from serializers import configure_json
+    from archive import register_archive_routes
+    from migrations import register_migration_commands, init_database
+    from email_queue import register_email_commands
+
+    # Register all routes
+    configure_json(app)
+    register_metrics(app)
+    register_compression(app)
+    register_routes(app)
+    register_auth_routes(app)
+    register_report_routes(app)
+    register_export_routes(app)
+    register_event_routes(app)
+    register_archive_routes(app)
+    register_migration_commands(app)
+    register_email_commands(app)
+
+    if app.config['DB_AUTO_MIGRATE']:
+        with app.app_context():
+            try:
+                init_database()
+                print("Database tables created successfully")
+            except Exception as e:
+                print(f"Error creating database tables: {e}")
+
+    return app
 
-# Register all routes
-register_routes(app)
-register_auth_routes(app)
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
+    # Development server; production runs through gunicorn (see gunicorn.conf.py and wsgi.py)
+    from migrations import init_database
+    from email_queue import start_email_worker
+    app = create_app()
+    debug = os.getenv('FLASK_DEBUG', 'true').lower() != 'false'
+    with app.app_context():
+        init_database()
+    # Single process: send the queued emails from a thread of the dev server
+    # (with the reloader, only in the child process that serves requests)
+    if not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_email_worker(app)
+    app.run(host='0.0.0.0', port=5000, debug=debug)
@@ -0,0 +1,191 @@
+import os
+import threading
+from datetime import date, datetime, timedelta
+import click
+from flask import request, jsonify
+from sqlalchemy import Column, Date, DateTime, Index, Integer, MetaData, Table, delete, func, insert, select
+from database import db, upsert_insert
+from models import Attendance, AttendanceArchiveYear
+from data_version import DataVersions
+
+# この日数より古い勤怠記録を年別のアーカイブテーブルへ移す
+ATTENDANCE_RETENTION_DAYS = int(os.getenv('ATTENDANCE_RETENTION_DAYS', '365'))
+
+# 打刻・リアルタイム配信の対象になりうる期間はアーカイブしない（日数）
+ARCHIVE_MIN_AGE_DAYS = 31
+
+ARCHIVE_COLUMNS = ('id', 'user_id', 'check_in', 'check_out', 'date', 'created_at')
+
+# Archive tables are created on demand, so they are kept out of db.metadata and create_all
+archive_metadata = MetaData()
+_metadata_lock = threading.Lock()
+
+def _parse_date(value):
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+class AttendanceArchive:
+    @staticmethod
+    def table_for(year):
+        """The attendance_archive_YYYY table; same columns as attendance, ids kept"""
+        name = f'attendance_archive_{year}'
+        with _metadata_lock:
+            table = archive_metadata.tables.get(name)
+            if table is None:
+                # No primary key: an id freed in the live table may be reused by a later row
+                table = Table(
+                    name, archive_metadata,
+                    Column('id', Integer, nullable=False),
+                    Column('user_id', Integer, nullable=False),
+                    Column('check_in', DateTime),
+                    Column('check_out', DateTime),
+                    Column('date', Date, nullable=False),
+                    Column('created_at', DateTime),
+                    Index(f'ix_{name}_date_id', 'date', 'id'),
+                    Index(f'ix_{name}_user_date', 'user_id', 'date'),
+                )
+            return table
+
+    @staticmethod
+    def tables(start_date=None, end_date=None, conn=None):
+        """Archive tables with rows in the date range (YYYY-MM-DD strings), newest year first.
+
+        Every archived row is older than every live row, so callers read the
+        live table first and these in order only when they need older rows.
+        Raises ValueError when a date is malformed.
+        """
+        registry = AttendanceArchiveYear.__table__
+        stmt = select(registry.c.year).where(registry.c.row_count > 0)
+        if start_date:
+            stmt = stmt.where(registry.c.max_date >= _parse_date(start_date))
+        if end_date:
+            stmt = stmt.where(registry.c.min_date <= _parse_date(end_date))
+        years = (conn or db.session).execute(stmt.order_by(registry.c.year.desc())).scalars().all()
+        return [AttendanceArchive.table_for(year) for year in years]
+
+    @staticmethod
+    def is_archived(target_date):
+        """True when target_date is not after the newest archived date"""
+        # Nothing newer than ARCHIVE_MIN_AGE_DAYS is ever archived: no query for current scans
+        if target_date > date.today() - timedelta(days=ARCHIVE_MIN_AGE_DAYS):
+            return False
+        newest = db.session.execute(select(func.max(AttendanceArchiveYear.max_date))).scalar()
+        return newest is not None and target_date <= newest
+
+    @staticmethod
+    def default_cutoff():
+        return date.today() - timedelta(days=ATTENDANCE_RETENTION_DAYS)
+
+    @staticmethod
+    def archive(before):
+        """Move attendance rows dated before `before` into the per-year archive tables.
+
+        One transaction per year, so an interrupted run leaves every row in
+        exactly one place and can simply be repeated. Returns the rows moved
+        per year.
+        """
+        if before > date.today() - timedelta(days=ARCHIVE_MIN_AGE_DAYS):
+            raise ValueError(f'Only rows older than {ARCHIVE_MIN_AGE_DAYS} days can be archived')
+
+        attendance = Attendance.__table__
+        oldest = db.session.execute(
+            select(func.min(attendance.c.date)).where(attendance.c.date < before)
+        ).scalar()
+        if oldest is None:
+            return []
+
+        results = []
+        for year in range(oldest.year, (before - timedelta(days=1)).year + 1):
+            in_year = (attendance.c.date >= date(year, 1, 1), attendance.c.date < min(date(year + 1, 1, 1), before))
+            table = AttendanceArchive.table_for(year)
+            conn = db.session.connection()
+            table.create(conn, checkfirst=True)
+
+            moved = AttendanceArchive._move_rows(conn, table, in_year)
+            if moved:
+                AttendanceArchive._update_registry(conn, year)
+                DataVersions.bump('attendance')
+            db.session.commit()
+            if moved:
+                results.append({'year': year, 'moved': moved})
+        return results
+
+    @staticmethod
+    def _move_rows(conn, table, where):
+        """Move matching attendance rows into an archive table; returns the number moved"""
+        attendance = Attendance.__table__
+        if conn.dialect.name == 'postgresql':
+            # One statement: under READ COMMITTED a row committed between a separate
+            # INSERT ... SELECT and DELETE would be deleted without being archived
+            moved = delete(attendance).where(*where).returning(
+                *[attendance.c[name] for name in ARCHIVE_COLUMNS]
+            ).cte('moved')
+            return conn.execute(
+                insert(table).from_select(ARCHIVE_COLUMNS, select(*[moved.c[name] for name in ARCHIVE_COLUMNS]))
+                .add_cte(moved)
+            ).rowcount
+
+        # SQLite has no DELETE in WITH; its single writer lock, taken by the INSERT,
+        # keeps other writers out until this transaction commits
+        conn.execute(insert(table).from_select(
+            ARCHIVE_COLUMNS, select(*[attendance.c[name] for name in ARCHIVE_COLUMNS]).where(*where)
+        ))
+        return conn.execute(delete(attendance).where(*where)).rowcount
+
+    @staticmethod
+    def delete_user_rows(user_ids):
+        """Delete archived rows of deleted users in the caller's transaction"""
+        conn = db.session.connection()
+        for table in AttendanceArchive.tables(conn=conn):
+            if conn.execute(delete(table).where(table.c.user_id.in_(user_ids))).rowcount:
+                AttendanceArchive._update_registry(conn, int(table.name.rsplit('_', 1)[1]))
+
+    @staticmethod
+    def _update_registry(conn, year):
+        table = AttendanceArchive.table_for(year)
+        registry = AttendanceArchiveYear.__table__
+        row_count, min_date, max_date = conn.execute(
+            select(func.count(), func.min(table.c.date), func.max(table.c.date)).select_from(table)
+        ).one()
+        values = {'row_count': row_count, 'min_date': min_date, 'max_date': max_date,
+                  'archived_at': datetime.utcnow()}
+        stmt = upsert_insert(registry, conn).values(year=year, **values)
+        conn.execute(stmt.on_conflict_do_update(index_elements=[registry.c.year], set_=values))
+
+def register_archive_routes(app):
+    """勤怠記録アーカイブのルートとCLIコマンドを登録"""
+
+    @app.route('/api/attendance/archive', methods=['GET', 'POST'])
+    def attendance_archive():
+        if request.method == 'GET':
+            years = AttendanceArchiveYear.query.order_by(AttendanceArchiveYear.year.desc()).all()
+            return jsonify({
+                'retention_days': ATTENDANCE_RETENTION_DAYS,
+                'years': [year.to_dict() for year in years]
+            })
+
+        try:
+            data = request.get_json(silent=True) or {}
+            try:
+                before = _parse_date(data['before']) if data.get('before') else AttendanceArchive.default_cutoff()
+            except (TypeError, ValueError):
+                return jsonify({'error': 'Invalid date format'}), 400
+
+            try:
+                results = AttendanceArchive.archive(before)
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+            return jsonify({'before': before.isoformat(), 'years': results})
+        except Exception as e:
+            db.session.rollback()
+            print(f"Error archiving attendance: {e}")
+            return jsonify({'error': 'Failed to archive attendance'}), 500
+
+    @app.cli.command('archive-attendance')
+    @click.option('--before', help='Archive rows dated before this day (YYYY-MM-DD)')
+    def archive_attendance_command(before):
+        """Move old attendance rows into the per-year archive tables."""
+        cutoff = _parse_date(before) if before else AttendanceArchive.default_cutoff()
+        results = AttendanceArchive.archive(cutoff)
+        for result in results:
+            click.echo(f"{result['year']}: archived {result['moved']} rows")
+        click.echo(f"Archived {sum(result['moved'] for result in results)} rows dated before {cutoff.isoformat()}")
@@ -0,0 +1,179 @@
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from flask import request, jsonify, Response, stream_with_context
+from sqlalchemy import delete, func, insert, select
+from database import db
+from models import User, Attendance, AttendanceEvent
+from serializers import ATTENDANCE_COLUMNS, attendance_dict
+
+# 新しいイベントの確認間隔（秒）。同一プロセス内の打刻は待たずに即時通知される
+EVENT_POLL_INTERVAL = float(os.getenv('ATTENDANCE_EVENT_POLL_INTERVAL', '1'))
+
+# 接続を維持するためのコメント送信間隔（秒）
+EVENT_KEEPALIVE_SECONDS = int(os.getenv('ATTENDANCE_EVENT_KEEPALIVE', '15'))
+
+# 1回の接続の最大時間（秒）。経過後はクライアントが Last-Event-ID 付きで再接続する
+EVENT_STREAM_MAX_SECONDS = int(os.getenv('ATTENDANCE_STREAM_MAX_SECONDS', '300'))
+
+# プロセスあたりの同時接続数の上限（打刻リクエスト用のスレッドを残すため）
+EVENT_STREAM_MAX_CLIENTS = int(os.getenv('ATTENDANCE_STREAM_MAX_CLIENTS', '2'))
+
+# イベントの保持期間（時間）
+EVENT_RETENTION_HOURS = int(os.getenv('ATTENDANCE_EVENT_RETENTION_HOURS', '24'))
+
+# 1回の送信で読み出す最大イベント数
+EVENT_BATCH_SIZE = 500
+
+# PostgreSQL で読み直す直近のイベント数。ID は INSERT 時に採番されコミット順とは限らないため、
+# 送信済み位置より前に遅れてコミットされたイベントを拾い直す（送信済みのものは除外）
+EVENT_LOOKBACK = int(os.getenv('ATTENDANCE_EVENT_LOOKBACK', '100'))
+
+_new_events = threading.Condition()
+_stream_slots = threading.BoundedSemaphore(EVENT_STREAM_MAX_CLIENTS)
+
+class AttendanceEvents:
+    @staticmethod
+    def record(action, attendance_id, user_id):
+        """Append a check_in/check_out event in the caller's transaction"""
+        db.session.execute(insert(AttendanceEvent.__table__).values(
+            attendance_id=attendance_id,
+            user_id=user_id,
+            action=action,
+            created_at=datetime.utcnow()
+        ))
+
+    @staticmethod
+    def notify():
+        """Wake the streams of this process after a scan was committed"""
+        with _new_events:
+            _new_events.notify_all()
+
+    @staticmethod
+    def wait(timeout):
+        with _new_events:
+            _new_events.wait(timeout)
+
+    @staticmethod
+    def latest_id():
+        """Id of the newest event, or 0; a list page loaded now is current up to this event"""
+        return db.session.execute(select(func.max(AttendanceEvent.id))).scalar() or 0
+
+    @staticmethod
+    def is_expired(last_event_id):
+        """True when events after last_event_id may already have been pruned"""
+        oldest = db.session.execute(select(func.min(AttendanceEvent.id))).scalar()
+        return bool(last_event_id) and oldest is not None and last_event_id < oldest
+
+    @staticmethod
+    def prune():
+        db.session.execute(delete(AttendanceEvent).where(
+            AttendanceEvent.created_at < datetime.utcnow() - timedelta(hours=EVENT_RETENTION_HOURS)
+        ))
+        db.session.commit()
+
+    @staticmethod
+    def lookback():
+        """How many ids before the cursor each poll re-reads.
+
+        PostgreSQL assigns sequence ids at INSERT, so event 11 can commit before
+        event 10; a plain `id > cursor` would never see 10. SQLite has a single
+        writer, so its ids become visible in commit order.
+        """
+        return EVENT_LOOKBACK if db.engine.dialect.name == 'postgresql' else 0
+
+    @staticmethod
+    def fetch_since(last_event_id, user_id=None, lookback=0):
+        """Events after last_event_id - lookback with the current attendance row and user, oldest first.
+
+        Items have the same shape as those of /api/attendance.
+        """
+        event, attendance, user = AttendanceEvent.__table__, Attendance.__table__, User.__table__
+        stmt = select(event.c.id, event.c.action, *ATTENDANCE_COLUMNS).select_from(event).join(
+            attendance, event.c.attendance_id == attendance.c.id
+        ).join(
+            user, event.c.user_id == user.c.id
+        ).where(event.c.id > last_event_id - lookback)
+        if user_id:
+            stmt = stmt.where(event.c.user_id == user_id)
+        stmt = stmt.order_by(event.c.id).limit(EVENT_BATCH_SIZE)
+
+        # Short-lived connection per poll: an open stream holds no session or transaction
+        with db.engine.connect() as conn:
+            rows = conn.execute(stmt).all()
+
+        return [(row[0], {'action': row[1], 'attendance': attendance_dict(row[2:])}) for row in rows]
+
+def register_event_routes(app):
+    """打刻イベント配信（Server-Sent Events）のルートを登録"""
+
+    @app.route('/api/attendance/stream', methods=['GET'])
+    def attendance_stream():
+        # EventSource sends Last-Event-ID on reconnect; the first connection passes
+        # the last_event_id returned by /api/attendance
+        resume_from = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+        try:
+            last_event_id = int(resume_from) if resume_from is not None else None
+        except ValueError:
+            return jsonify({'error': 'Invalid last event id'}), 400
+        user_id = request.args.get('user_id', type=int)
+
+        if not _stream_slots.acquire(blocking=False):
+            response = jsonify({'error': 'Too many event streams'})
+            response.headers['Retry-After'] = '10'
+            return response, 503
+
+        try:
+            AttendanceEvents.prune()
+            # A client whose position was pruned reloads its list and continues from now
+            expired = AttendanceEvents.is_expired(last_event_id)
+            if expired or last_event_id is None:
+                last_event_id = AttendanceEvents.latest_id()
+            db.session.remove()
+        except Exception as e:
+            _stream_slots.release()
+            db.session.rollback()
+            print(f"Error opening attendance stream: {e}")
+            return jsonify({'error': 'Failed to open attendance stream'}), 500
+
+        def generate(last_event_id):
+            try:
+                yield 'retry: 3000\n\n'
+                if expired:
+                    yield f'id: {last_event_id}\nevent: reset\ndata: {{}}\n\n'
+
+                lookback = AttendanceEvents.lookback()
+                # Ids inside the lookback window already sent on this connection. After a
+                # reconnect the window is sent again; clients merge items by attendance id
+                delivered = set()
+                deadline = time.monotonic() + EVENT_STREAM_MAX_SECONDS
+                keepalive_at = time.monotonic() + EVENT_KEEPALIVE_SECONDS
+                while time.monotonic() < deadline:
+                    events = AttendanceEvents.fetch_since(last_event_id, user_id, lookback)
+                    fresh = [(event_id, payload) for event_id, payload in events if event_id not in delivered]
+                    for event_id, payload in fresh:
+                        last_event_id = max(last_event_id, event_id)
+                        yield f'id: {last_event_id}\nevent: attendance\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n'
+                    if lookback:
+                        delivered.update(event_id for event_id, _ in fresh)
+                        delivered = {event_id for event_id in delivered if event_id > last_event_id - lookback}
+                    if fresh:
+                        keepalive_at = time.monotonic() + EVENT_KEEPALIVE_SECONDS
+                        if len(events) == EVENT_BATCH_SIZE:
+                            continue
+                    elif time.monotonic() >= keepalive_at:
+                        yield ': keepalive\n\n'
+                        keepalive_at = time.monotonic() + EVENT_KEEPALIVE_SECONDS
+                    AttendanceEvents.wait(EVENT_POLL_INTERVAL)
+            except Exception as e:
+                print(f"Error streaming attendance events: {e}")
+
+        response = Response(stream_with_context(generate(last_event_id)), mimetype='text/event-stream')
+        response.headers['Cache-Control'] = 'no-cache'
+        # Stop reverse proxies from buffering the stream
+        response.headers['X-Accel-Buffering'] = 'no'
+        # Released when the server closes the response, even if the client left before the first event
+        response.call_on_close(_stream_slots.release)
+        return response
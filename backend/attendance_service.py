@@ -0,0 +1,263 @@
+import json
+import os
+from datetime import datetime, timedelta
+from sqlalchemy import Date, DateTime, Integer, bindparam, case, delete, exists, literal, select, update
+from cache import LRUCache
+from database import db, upsert_insert
+from models import User, Attendance, ScanReceipt
+from rollups import RollupService
+from attendance_events import AttendanceEvents
+from archive import AttendanceArchive
+from qr_token import QRToken, InvalidQRToken
+
+# QRコードのユーザー名 → ユーザーID（および署名付きQRのユーザー存在確認）のキャッシュ
+# （/api/users の作成・削除で無効化。他プロセスで削除されたユーザーは打刻時の存在条件で検出して無効化）
+user_cache = LRUCache(
+    max_size=int(os.getenv('USER_CACHE_SIZE', '4096')),
+    ttl=int(os.getenv('USER_CACHE_TTL', '300'))
+)
+
+# 移行期間中は旧形式（ユーザー名|日付）のQRコードも受け付ける
+QR_ACCEPT_LEGACY = os.getenv('QR_ACCEPT_LEGACY', 'true').lower() != 'false'
+
+# 一括アップロードの重複排除記録の保持期間
+SCAN_RECEIPT_RETENTION_DAYS = int(os.getenv('SCAN_RECEIPT_RETENTION_DAYS', '7'))
+
+# 一括アップロードで受け付ける打刻時刻の範囲（端末がオフラインでいられる時間と、端末の時計の進みの許容値）
+SCAN_MAX_OFFLINE_HOURS = int(os.getenv('SCAN_MAX_OFFLINE_HOURS', '72'))
+SCAN_CLOCK_SKEW_SECONDS = int(os.getenv('SCAN_CLOCK_SKEW_SECONDS', '300'))
+
+class ScanError(Exception):
+    """A scan that cannot be recorded; carries the HTTP status to answer with"""
+
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+class AttendanceService:
+    @staticmethod
+    def parse_qr(qr_data, scanned_at=None):
+        """Resolve a scanned QR payload to (user_id, date); raises ScanError.
+
+        scanned_at is when an uploaded scan happened; its code is checked for
+        expiry at that time instead of now.
+        """
+        if not qr_data:
+            raise ScanError('QR data is required')
+        if not isinstance(qr_data, str):
+            raise ScanError('QR data must be a string')
+        
+        # Signed payloads are verified in memory; forged or expired codes never reach the DB
+        if QRToken.is_signed(qr_data):
+            try:
+                user_id, target_date_obj = QRToken.verify(qr_data, now=scanned_at)
+            except InvalidQRToken as e:
+                raise ScanError(str(e))
+            if not AttendanceService.user_exists(user_id):
+                raise ScanError('User not found', 404)
+            return user_id, target_date_obj
+        
+        if not QR_ACCEPT_LEGACY:
+            raise ScanError('Legacy QR codes are no longer accepted')
+        
+        # Legacy "user_name|date" payload
+        try:
+            user_name, target_date = qr_data.split('|')
+        except ValueError:
+            raise ScanError('Invalid QR code format')
+        
+        # Find user (cached, so repeated scans skip the lookup query)
+        user_id = AttendanceService.resolve_user_id(user_name)
+        if user_id is None:
+            raise ScanError('User not found', 404)
+        
+        # Parse date
+        try:
+            target_date_obj = datetime.strptime(target_date, '%Y-%m-%d').date()
+        except ValueError:
+            raise ScanError('Invalid date format')
+        
+        # Legacy codes never expire; keep archived days out of the live table
+        if AttendanceArchive.is_archived(target_date_obj):
+            raise ScanError('Attendance for this date has been archived')
+        
+        return user_id, target_date_obj
+
+    @staticmethod
+    def filters(user_id=None, start_date=None, end_date=None, table=None):
+        """Build WHERE clauses for the attendance list/export query parameters.
+
+        Dates are YYYY-MM-DD strings; raises ValueError when one is malformed.
+        table is an archive table to filter instead of attendance.
+        """
+        columns = (Attendance.__table__ if table is None else table).c
+        clauses = []
+        if user_id:
+            clauses.append(columns.user_id == user_id)
+        if start_date:
+            clauses.append(columns.date >= datetime.strptime(start_date, '%Y-%m-%d').date())
+        if end_date:
+            clauses.append(columns.date <= datetime.strptime(end_date, '%Y-%m-%d').date())
+        return clauses
+
+    @staticmethod
+    def resolve_user_id(user_name):
+        """Return the id of the user with this name, or None if there is none"""
+        user_id = user_cache.get(user_name)
+        if user_id is not None:
+            return user_id
+
+        user_id = db.session.query(User.id).filter_by(name=user_name).scalar()
+        # Unknown names are not cached so a newly created user is found immediately
+        if user_id is not None:
+            user_cache.set(user_name, user_id)
+        return user_id
+
+    @staticmethod
+    def user_exists(user_id):
+        """Primary-key existence check for signed payloads, cached like name lookups"""
+        key = ('id', user_id)
+        if user_cache.get(key):
+            return True
+
+        exists = db.session.get(User, user_id) is not None
+        if exists:
+            user_cache.set(key, True)
+        return exists
+
+    @staticmethod
+    def invalidate_user(user_name, user_id=None):
+        """Drop cached lookups after the user was created, renamed or deleted"""
+        user_cache.invalidate(user_name)
+        if user_id is not None:
+            user_cache.invalidate(('id', user_id))
+
+    @staticmethod
+    def record_scan(user_id, target_date, scanned_at):
+        """Check a user in or out for a date with a single upsert statement.
+
+        Returns (action, attendance) where action is 'check_in', 'check_out'
+        or 'completed' and attendance is the row as a dict. Daily and monthly
+        rollups and the live event feed are updated in the same transaction;
+        the event also changes the attendance data version. Raises ScanError when the user no
+        longer exists (deleted through another worker, whose cache still had it).
+        The caller commits and then calls AttendanceEvents.notify().
+        """
+        table = Attendance.__table__
+        user = User.__table__
+        # INSERT ... SELECT ... WHERE EXISTS: nothing is written for a deleted user
+        stmt = upsert_insert(table).from_select(
+            ['user_id', 'date', 'check_in'],
+            select(
+                literal(user_id, Integer), literal(target_date, Date), literal(scanned_at, DateTime)
+            ).where(exists().where(user.c.id == user_id))
+        )
+        # Existing row without check-out: the earlier of the two times is the check-in and
+        # the later one the check-out, so an offline scan uploaded after a live check-in
+        # that happened later still gives check_in <= check_out.
+        # Existing completed row: the WHERE clause skips the update and nothing is returned.
+        scanned_earlier = table.c.check_in > literal(scanned_at, DateTime)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[table.c.user_id, table.c.date],
+            set_={
+                'check_in': case((scanned_earlier, literal(scanned_at, DateTime)), else_=table.c.check_in),
+                'check_out': case((scanned_earlier, table.c.check_in), else_=literal(scanned_at, DateTime))
+            },
+            where=table.c.check_out.is_(None)
+        ).returning(*table.c)
+
+        row = db.session.execute(stmt).mappings().first()
+
+        if row is None:
+            attendance = Attendance.query.filter_by(user_id=user_id, date=target_date).first()
+            if attendance is None:
+                # Deleted elsewhere: this process may also map the user's name to the id
+                user_cache.clear()
+                raise ScanError('User not found', 404)
+            return 'completed', attendance.to_dict()
+
+        action = 'check_in' if row['check_out'] is None else 'check_out'
+        RollupService.apply(db.session.connection(), row['user_id'], row['date'], row['check_in'], row['check_out'])
+        AttendanceEvents.record(action, row['id'], row['user_id'])
+        return action, Attendance(**row).to_dict()
+
+    @staticmethod
+    def record_scan_batch(scans):
+        """Apply uploaded scans in one transaction, in scanned_at order.
+
+        scans is a list of dicts with idempotency_key, qr_data and scanned_at
+        (a naive local datetime). Keys already seen return their stored result
+        flagged as duplicate instead of being applied again. Scans rejected with
+        a ScanError keep no receipt, so a later upload of the same key is retried
+        (e.g. once the user exists). Returns one result per scan in the order
+        given. The caller commits.
+        """
+        receipts = ScanReceipt.__table__
+        keys = list(dict.fromkeys(scan['idempotency_key'] for scan in scans))
+
+        # Claim the keys first: only scans whose receipt row we inserted are applied,
+        # so a replay racing with the original upload cannot apply them twice
+        now = datetime.utcnow()
+        claimed = set()
+        if keys:
+            stmt = upsert_insert(receipts).values([
+                {'idempotency_key': key, 'status': 'pending', 'created_at': now} for key in keys
+            ]).on_conflict_do_nothing(index_elements=[receipts.c.idempotency_key])
+            claimed = set(db.session.execute(stmt.returning(receipts.c.idempotency_key)).scalars())
+
+        stored = {}
+        if len(claimed) < len(keys):
+            rows = db.session.execute(
+                select(receipts.c.idempotency_key, receipts.c.result)
+                .where(receipts.c.idempotency_key.in_([key for key in keys if key not in claimed]))
+            )
+            stored = {key: json.loads(result) if result else {'status': 'pending'} for key, result in rows}
+
+        # Offline kiosks upload late, but only within SCAN_MAX_OFFLINE_HOURS and never from the future
+        oldest_accepted = datetime.now() - timedelta(hours=SCAN_MAX_OFFLINE_HOURS)
+        newest_accepted = datetime.now() + timedelta(seconds=SCAN_CLOCK_SKEW_SECONDS)
+
+        outcomes = {}
+        for scan in sorted(scans, key=lambda scan: scan['scanned_at']):
+            key = scan['idempotency_key']
+            if key not in claimed or key in outcomes:
+                continue
+            try:
+                if scan['scanned_at'] > newest_accepted:
+                    raise ScanError('scanned_at is in the future')
+                if scan['scanned_at'] < oldest_accepted:
+                    raise ScanError(f'scanned_at is more than {SCAN_MAX_OFFLINE_HOURS} hours old')
+                user_id, target_date = AttendanceService.parse_qr(scan['qr_data'], scanned_at=scan['scanned_at'])
+                action, attendance = AttendanceService.record_scan(user_id, target_date, scan['scanned_at'])
+                outcomes[key] = {'status': action, 'attendance': attendance}
+            except ScanError as e:
+                outcomes[key] = {'status': 'error', 'error': e.message}
+
+        # Store results of applied scans only; release the claims of rejected ones
+        stored_outcomes = {key: outcome for key, outcome in outcomes.items() if outcome['status'] != 'error'}
+        rejected_keys = [key for key in outcomes if key not in stored_outcomes]
+        if stored_outcomes:
+            db.session.execute(
+                update(receipts).where(receipts.c.idempotency_key == bindparam('key')),
+                [{'key': key, 'status': outcome['status'], 'result': json.dumps(outcome)}
+                 for key, outcome in stored_outcomes.items()]
+            )
+        if rejected_keys:
+            db.session.execute(delete(receipts).where(receipts.c.idempotency_key.in_(rejected_keys)))
+
+        # Forget receipts older than the retention period
+        db.session.execute(delete(receipts).where(
+            receipts.c.created_at < now - timedelta(days=SCAN_RECEIPT_RETENTION_DAYS)
+        ))
+
+        results = []
+        applied = set()
+        for scan in scans:
+            key = scan['idempotency_key']
+            if key in outcomes and key not in applied:
+                applied.add(key)
+                results.append({'idempotency_key': key, 'duplicate': False, **outcomes[key]})
+            else:
+                results.append({'idempotency_key': key, 'duplicate': True, **stored.get(key, outcomes.get(key, {}))})
+        return results
@@ -0,0 +1,117 @@
+"""Minimal local OAuth token endpoint and Gmail API for testing the gmail_api transport.
+
+Issues access tokens for any refresh token and accepts messages sent with
+the most recently issued token; older tokens get 401 like expired ones.
+Run standalone with:
+
+    python -m bench.gmail_stub --port 8025
+
+and point the backend at it with EMAIL_TRANSPORT=gmail_api
+GMAIL_TOKEN_URL=http://127.0.0.1:8025/token GMAIL_API_URL=http://127.0.0.1:8025
+and any GMAIL_CLIENT_ID, GMAIL_CLIENT_SECRET and GMAIL_REFRESH_TOKEN.
+"""
+import argparse
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class _GmailHandler(BaseHTTPRequestHandler):
+    # Keep-alive, so connection reuse by the client is visible in the counters
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+        if self.path == '/token':
+            self._reply(200, {'access_token': self.server.issue_token(), 'expires_in': self.server.expires_in})
+        elif self.path == '/gmail/v1/users/me/messages/send':
+            token = self.headers.get('Authorization', '').removeprefix('Bearer ')
+            if not self.server.accept(token, len(body)):
+                self._reply(401, {'error': {'code': 401, 'message': 'Invalid Credentials'}})
+                return
+            self._reply(200, {'id': f'msg-{self.server.messages}', 'labelIds': ['SENT']})
+        else:
+            self._reply(404, {'error': 'not found'})
+
+
+class StubGmailServer(ThreadingHTTPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, expires_in=3600):
+        super().__init__((host, port), _GmailHandler)
+        self._lock = threading.Lock()
+        self.expires_in = expires_in
+        self.current_token = None
+        self.refreshes = 0
+        self.messages = 0
+        self.bytes = 0
+        self.connections = 0
+
+    def process_request(self, request, client_address):
+        with self._lock:
+            self.connections += 1
+        super().process_request(request, client_address)
+
+    def issue_token(self):
+        with self._lock:
+            self.refreshes += 1
+            self.current_token = f'token-{self.refreshes}'
+            return self.current_token
+
+    def revoke(self):
+        """Reject the current token, as if it had expired early"""
+        with self._lock:
+            self.current_token = None
+
+    def accept(self, token, size):
+        with self._lock:
+            if token != self.current_token:
+                return False
+            self.messages += 1
+            self.bytes += size
+            return True
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    @property
+    def url(self):
+        return f'http://{self.server_address[0]}:{self.port}'
+
+    def start(self):
+        """Serve in a daemon thread and return self"""
+        threading.Thread(target=self.serve_forever, name='gmail-stub', daemon=True).start()
+        return self
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local OAuth/Gmail API stub server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8025)
+    parser.add_argument('--expires-in', type=int, default=3600)
+    args = parser.parse_args()
+
+    server = StubGmailServer(args.host, args.port, args.expires_in)
+    print(f"Gmail stub listening on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(f"Issued {server.refreshes} tokens, received {server.messages} messages over {server.connections} connections")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,314 @@
+"""Load test and benchmark for the scan, listing, QR and user endpoints.
+
+Seeds a synthetic SQLite database (users x days of history), drives the
+Flask app in-process with concurrent simulated scanners and admin readers,
+sends email through a local stub SMTP server and reports latency
+percentiles, throughput and SQL queries per request for each endpoint.
+
+Run from the backend directory:
+
+    python -m bench.loadtest --users 500 --days 30 --duration 15
+
+Pass --max-p95-ms / --max-queries to turn the run into a regression gate
+(non-zero exit status when a threshold is exceeded), and --json to keep
+the results for comparison between builds.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+
+from bench.smtp_stub import StubSMTPServer
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(int(round(pct / 100.0 * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+class Recorder:
+    """Collects per-endpoint latencies, status codes and query counts from all workers"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.queries = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def record(self, endpoint, seconds, status, queries):
+        with self._lock:
+            self.latencies[endpoint].append(seconds * 1000.0)
+            self.queries[endpoint].append(queries)
+            if status >= 500:
+                self.errors[endpoint] += 1
+
+    def summary(self, elapsed):
+        rows = []
+        for endpoint in sorted(self.latencies):
+            latencies = sorted(self.latencies[endpoint])
+            queries = self.queries[endpoint]
+            rows.append({
+                'endpoint': endpoint,
+                'requests': len(latencies),
+                'errors': self.errors[endpoint],
+                'throughput_rps': len(latencies) / elapsed if elapsed else 0.0,
+                'p50_ms': percentile(latencies, 50),
+                'p95_ms': percentile(latencies, 95),
+                'p99_ms': percentile(latencies, 99),
+                'queries_per_request': sum(queries) / len(queries) if queries else 0.0
+            })
+        return rows
+
+
+class QueryCounter:
+    """Counts SQL statements executed by the current thread"""
+
+    def __init__(self, engine):
+        self._local = threading.local()
+        from sqlalchemy import event
+        event.listen(engine, 'before_cursor_execute', self._on_execute)
+
+    def _on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self._local.count = getattr(self._local, 'count', 0) + 1
+
+    def reset(self):
+        self._local.count = 0
+
+    @property
+    def count(self):
+        return getattr(self._local, 'count', 0)
+
+
+def configure_environment(args, smtp_port):
+    """Point the app at the benchmark database and the stub SMTP server before it is imported"""
+    os.environ['DATABASE_URL'] = f'sqlite:///{args.db}'
+    os.environ['SMTP_SERVER'] = '127.0.0.1'
+    os.environ['SMTP_PORT'] = str(smtp_port)
+    os.environ['SMTP_USE_TLS'] = 'false'
+    os.environ['SMTP_AUTH'] = 'false'
+    os.environ['FROM_EMAIL'] = 'bench@example.com'
+    os.environ['EMAIL_POLL_INTERVAL'] = '0.5'
+    if not args.qr_disk_cache:
+        os.environ['QR_CACHE_DIR'] = ''
+
+
+def seed(app, users, days):
+    """Insert synthetic users and complete attendance history for the past days"""
+    from sqlalchemy import func, insert
+    from database import db
+    from models import User, Attendance
+    from rollups import RollupService
+
+    rng = random.Random(42)
+    with app.app_context():
+        if db.session.query(func.count(User.id)).scalar():
+            print("Database already seeded, reusing it")
+            return
+
+        now = datetime.utcnow()
+        db.session.execute(insert(User.__table__), [
+            {'name': f'bench-user-{i:05d}', 'email': f'bench-user-{i:05d}@example.com',
+             'department': f'dept-{i % 5}', 'created_at': now}
+            for i in range(users)
+        ])
+
+        user_ids = [row[0] for row in db.session.query(User.id).order_by(User.id)]
+        today = date.today()
+        chunk = []
+        for offset in range(days, 0, -1):
+            target_date = today - timedelta(days=offset)
+            for user_id in user_ids:
+                check_in = datetime.combine(target_date, datetime.min.time()) + timedelta(
+                    hours=8, minutes=rng.randint(30, 90))
+                chunk.append({
+                    'user_id': user_id, 'date': target_date, 'check_in': check_in,
+                    'check_out': check_in + timedelta(hours=9, minutes=rng.randint(-60, 60)),
+                    'created_at': check_in
+                })
+                if len(chunk) >= 5000:
+                    db.session.execute(insert(Attendance.__table__), chunk)
+                    chunk = []
+        if chunk:
+            db.session.execute(insert(Attendance.__table__), chunk)
+
+        RollupService.rebuild(db.session.connection())
+        db.session.commit()
+
+
+def run_load(app, args, recorder, counter):
+    """Run scanner, reader and mailer workers until the duration elapses"""
+    from database import db
+    from models import User
+    from qr_service import QRService
+
+    with app.app_context():
+        users = [(u.id, u.name) for u in db.session.query(User.id, User.name)]
+    today = date.today().isoformat()
+    deadline = time.monotonic() + args.duration
+
+    def call(client, endpoint, method, path, **kwargs):
+        counter.reset()
+        started = time.perf_counter()
+        response = client.open(path, method=method, **kwargs)
+        recorder.record(endpoint, time.perf_counter() - started, response.status_code, counter.count)
+        return response
+
+    def scanner(seed_value):
+        rng = random.Random(seed_value)
+        client = app.test_client()
+        while time.monotonic() < deadline:
+            user_id, name = rng.choice(users)
+            call(client, 'POST /api/attendance/check', 'POST', '/api/attendance/check',
+                 json={'qr_data': QRService.build_qr_data(user_id, today)})
+
+    def reader(seed_value):
+        rng = random.Random(seed_value)
+        client = app.test_client()
+        while time.monotonic() < deadline:
+            response = call(client, 'GET /api/attendance', 'GET', '/api/attendance?limit=100')
+            cursor = response.get_json().get('next_cursor') if response.status_code == 200 else None
+            if cursor:
+                call(client, 'GET /api/attendance (next page)', 'GET',
+                     f'/api/attendance?limit=100&cursor={cursor}')
+            call(client, 'GET /api/users', 'GET', '/api/users')
+            user_id, name = rng.choice(users)
+            call(client, 'POST /api/generate-qr', 'POST', '/api/generate-qr',
+                 json={'user_id': user_id, 'date': today})
+
+    def mailer(seed_value):
+        rng = random.Random(seed_value)
+        client = app.test_client()
+        while time.monotonic() < deadline:
+            user_id, name = rng.choice(users)
+            call(client, 'POST /api/send-qr-email', 'POST', '/api/send-qr-email',
+                 json={'user_id': user_id, 'date': today})
+            time.sleep(0.05)
+
+    threads = []
+    for kind, count in ((scanner, args.scanners), (reader, args.readers), (mailer, args.mailers)):
+        for i in range(count):
+            threads.append(threading.Thread(target=kind, args=(len(threads),), daemon=True))
+
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - started
+
+
+def run_bulk_email(app, count, recorder, counter):
+    """Time one bulk QR email request for the first count users"""
+    from database import db
+    from models import User
+
+    with app.app_context():
+        user_ids = [row[0] for row in db.session.query(User.id).order_by(User.id).limit(count)]
+    client = app.test_client()
+    counter.reset()
+    started = time.perf_counter()
+    response = client.post('/api/send-qr-email/bulk', json={'user_ids': user_ids})
+    recorder.record('POST /api/send-qr-email/bulk', time.perf_counter() - started,
+                    response.status_code, counter.count)
+
+
+def print_report(rows, elapsed, smtp):
+    header = f"{'endpoint':<34} {'reqs':>7} {'err':>5} {'rps':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'q/req':>6}"
+    print(header)
+    print('-' * len(header))
+    for row in rows:
+        print(f"{row['endpoint']:<34} {row['requests']:>7} {row['errors']:>5} {row['throughput_rps']:>8.1f} "
+              f"{row['p50_ms']:>8.2f} {row['p95_ms']:>8.2f} {row['p99_ms']:>8.2f} {row['queries_per_request']:>6.1f}")
+    total = sum(row['requests'] for row in rows)
+    print(f"\n{total} requests in {elapsed:.1f}s ({total / elapsed:.1f} req/s); "
+          f"SMTP stub received {smtp.messages} messages over {smtp.connections} connections")
+
+
+def check_thresholds(rows, args):
+    failures = []
+    for row in rows:
+        if args.max_p95_ms is not None and row['p95_ms'] > args.max_p95_ms:
+            failures.append(f"{row['endpoint']}: p95 {row['p95_ms']:.2f}ms > {args.max_p95_ms}ms")
+        if args.max_queries is not None and row['queries_per_request'] > args.max_queries:
+            failures.append(f"{row['endpoint']}: {row['queries_per_request']:.1f} queries/request > {args.max_queries}")
+        if row['errors']:
+            failures.append(f"{row['endpoint']}: {row['errors']} server errors")
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the attendance backend')
+    parser.add_argument('--users', type=int, default=200, help='synthetic users to seed')
+    parser.add_argument('--days', type=int, default=30, help='days of attendance history per user')
+    parser.add_argument('--scanners', type=int, default=8, help='concurrent simulated QR scanners')
+    parser.add_argument('--readers', type=int, default=2, help='concurrent admin readers')
+    parser.add_argument('--mailers', type=int, default=1, help='concurrent single-email senders')
+    parser.add_argument('--bulk-email', type=int, default=50, help='users in the bulk email run (0 to skip)')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds to run the mixed load')
+    parser.add_argument('--db', help='SQLite file to use (default: a fresh temporary file)')
+    parser.add_argument('--qr-disk-cache', action='store_true', help='keep the on-disk QR cache enabled')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--max-p95-ms', type=float, help='fail when any endpoint p95 exceeds this')
+    parser.add_argument('--max-queries', type=float, help='fail when any endpoint exceeds this many queries/request')
+    parser.add_argument('--verbose', action='store_true', help='show application output during the run')
+    args = parser.parse_args(argv)
+
+    if not args.db:
+        args.db = os.path.join(tempfile.mkdtemp(prefix='attendance-bench-'), 'bench.db')
+
+    smtp = StubSMTPServer().start()
+    configure_environment(args, smtp.port)
+
+    quiet = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+    with quiet:
+        from app import create_app
+        from database import db
+        from migrations import init_database
+        from email_queue import start_email_worker
+        app = create_app()
+        with app.app_context():
+            init_database()
+            counter = QueryCounter(db.engine)
+        if args.mailers:
+            start_email_worker(app)
+
+    print(f"Seeding {args.users} users x {args.days} days into {args.db}")
+    started = time.perf_counter()
+    with quiet:
+        seed(app, args.users, args.days)
+    print(f"Seeded in {time.perf_counter() - started:.1f}s")
+
+    print(f"Running {args.scanners} scanners, {args.readers} readers, {args.mailers} mailers for {args.duration:.0f}s")
+    recorder = Recorder()
+    with quiet:
+        elapsed = run_load(app, args, recorder, counter)
+        if args.bulk_email:
+            run_bulk_email(app, args.bulk_email, recorder, counter)
+
+    rows = recorder.summary(elapsed)
+    print_report(rows, elapsed, smtp)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'args': vars(args), 'elapsed_s': elapsed, 'smtp_messages': smtp.messages,
+                       'endpoints': rows}, f, indent=2)
+
+    failures = check_thresholds(rows, args)
+    for failure in failures:
+        print(f"FAIL {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,99 @@
+"""Minimal local SMTP server for benchmarks and manual email testing.
+
+Accepts every message without TLS or authentication and only counts
+what it receives. Run standalone with:
+
+    python -m bench.smtp_stub --port 1025
+
+and point the backend at it with SMTP_SERVER=127.0.0.1 SMTP_PORT=1025
+SMTP_USE_TLS=false SMTP_AUTH=false.
+"""
+import argparse
+import socketserver
+import threading
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    def _reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        self._reply('220 smtp-stub ready')
+        in_data = False
+        size = 0
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+
+            if in_data:
+                if line == b'.\r\n':
+                    in_data = False
+                    self.server.record_message(size)
+                    self._reply('250 OK')
+                else:
+                    size += len(line)
+                continue
+
+            command = line[:4].upper()
+            if command in (b'EHLO', b'HELO'):
+                self._reply('250 smtp-stub')
+            elif command == b'DATA':
+                in_data = True
+                size = 0
+                self._reply('354 End data with <CR><LF>.<CR><LF>')
+            elif command == b'QUIT':
+                self._reply('221 Bye')
+                return
+            else:
+                # MAIL, RCPT, RSET, NOOP ...
+                self._reply('250 OK')
+
+
+class StubSMTPServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0):
+        super().__init__((host, port), _SMTPHandler)
+        self._lock = threading.Lock()
+        self.messages = 0
+        self.bytes = 0
+        self.connections = 0
+
+    def process_request(self, request, client_address):
+        with self._lock:
+            self.connections += 1
+        super().process_request(request, client_address)
+
+    def record_message(self, size):
+        with self._lock:
+            self.messages += 1
+            self.bytes += size
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        """Serve in a daemon thread and return self"""
+        threading.Thread(target=self.serve_forever, name='smtp-stub', daemon=True).start()
+        return self
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local SMTP stub server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=1025)
+    args = parser.parse_args()
+
+    server = StubSMTPServer(args.host, args.port)
+    print(f"SMTP stub listening on {args.host}:{server.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(f"Received {server.messages} messages over {server.connections} connections")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""Cold start time of a worker process.
+
+Starts fresh interpreters that import the WSGI app the way each gunicorn
+worker does, serve one request, and report how long that took and which
+heavy optional modules (qrcode/Pillow, the MIME stack, smtplib, requests)
+were loaded along the way. The database is created once beforehand, as
+`flask init-db` does in the container.
+
+Run from the backend directory:
+
+    python -m bench.startup --runs 10
+
+Pass --max-ms to turn the run into a regression gate (non-zero exit status
+when the median import + first request time exceeds it), and --json to keep
+the results for comparison between builds.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+HEAVY_MODULES = ('qrcode', 'PIL', 'email.mime', 'smtplib', 'requests')
+
+# Runs in the child process; prints one JSON line
+CHILD = """
+import json, sys, time
+started = time.perf_counter()
+import wsgi
+imported = time.perf_counter()
+response = wsgi.app.test_client().get('/api/health')
+served = time.perf_counter()
+print(json.dumps({
+    'import_ms': (imported - started) * 1000,
+    'first_request_ms': (served - imported) * 1000,
+    'status': response.status_code,
+    'heavy_modules': [name for name in HEAVY_MODULES if name in sys.modules],
+}))
+"""
+
+
+def child_environment(db_path, auto_migrate=False):
+    env = dict(os.environ)
+    env.update({
+        'DATABASE_URL': f'sqlite:///{db_path}',
+        'DB_AUTO_MIGRATE': 'true' if auto_migrate else 'false',
+        'QR_CACHE_DIR': '',
+        'GMAIL_TOKEN_FILE': '',
+    })
+    return env
+
+
+def run_child(env):
+    code = f'HEAVY_MODULES = {HEAVY_MODULES!r}\n{CHILD}'
+    started = time.perf_counter()
+    result = subprocess.run([sys.executable, '-c', code], env=env, capture_output=True, text=True, check=True)
+    wall_ms = (time.perf_counter() - started) * 1000
+    sample = json.loads(result.stdout.strip().splitlines()[-1])
+    sample['process_ms'] = wall_ms
+    return sample
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Measure worker cold start time')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--max-ms', type=float, help='fail when the median import + first request time exceeds this')
+    args = parser.parse_args(argv)
+
+    db_path = os.path.join(tempfile.mkdtemp(prefix='attendance-startup-'), 'startup.db')
+    run_child(child_environment(db_path, auto_migrate=True))
+
+    env = child_environment(db_path)
+    samples = [run_child(env) for _ in range(args.runs)]
+
+    print(f"{'':<18}{'median':>10}{'min':>10}{'max':>10}")
+    summary = {}
+    for key in ('import_ms', 'first_request_ms', 'process_ms'):
+        values = [sample[key] for sample in samples]
+        summary[key] = statistics.median(values)
+        print(f"{key:<18}{statistics.median(values):>10.1f}{min(values):>10.1f}{max(values):>10.1f}")
+
+    heavy = sorted({name for sample in samples for name in sample['heavy_modules']})
+    print(f"heavy modules loaded: {', '.join(heavy) or 'none'}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'args': vars(args), 'summary': summary, 'heavy_modules': heavy, 'samples': samples}, f, indent=2)
+
+    failed = [sample for sample in samples if sample['status'] != 200]
+    if failed:
+        print(f"FAIL: {len(failed)} runs got a non-200 health check")
+        return 1
+    startup_ms = summary['import_ms'] + summary['first_request_ms']
+    if args.max_ms is not None and startup_ms > args.max_ms:
+        print(f"FAIL: median startup {startup_ms:.1f} ms > {args.max_ms:.1f} ms")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
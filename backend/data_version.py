@@ -0,0 +1,97 @@
+import zlib
+from datetime import datetime
+from functools import wraps
+from flask import request, Response
+from sqlalchemy import func, select, update
+from werkzeug.http import is_resource_modified
+from database import db
+from models import DataVersion, AttendanceEvent
+
+# 変更カウンタを持つリソース
+TRACKED_RESOURCES = ('user', 'attendance')
+
+# 打刻は data_version の行を更新せず、打刻ごとに書かれる attendance_event から版を導出する
+# （全ワーカーの打刻が1行のロックで直列化されないように）。カウンタはアーカイブ・再集計・ユーザー削除で更新
+EVENT_DERIVED_RESOURCES = ('attendance',)
+
+class DataVersions:
+    @staticmethod
+    def bump(*names):
+        """Mark resources as changed in the caller's transaction (not needed for scans, see event_state)"""
+        db.session.execute(
+            update(DataVersion.__table__)
+            .where(DataVersion.__table__.c.name.in_(names))
+            .values(version=DataVersion.__table__.c.version + 1, updated_at=datetime.utcnow())
+        )
+
+    @staticmethod
+    def event_state():
+        """(oldest id, newest id, count, newest time) of attendance_event.
+
+        Every committed scan adds an event, so this changes with each scan even
+        when PostgreSQL commits events out of id order (the count grows), and
+        with each prune (the oldest id grows).
+        """
+        event = AttendanceEvent.__table__
+        return db.session.execute(
+            select(func.min(event.c.id), func.max(event.c.id), func.count(), func.max(event.c.created_at))
+        ).one()
+
+    @staticmethod
+    def validators(*names):
+        """(etag, last_modified) for the current state of the named resources.
+
+        One primary-key query, plus one over attendance_event for attendance;
+        the ETag also covers the query string so each filtered view of a list
+        gets its own tag.
+        """
+        table = DataVersion.__table__
+        rows = dict(
+            (name, (version, updated_at)) for name, version, updated_at in db.session.execute(
+                select(table.c.name, table.c.version, table.c.updated_at).where(table.c.name.in_(names))
+            )
+        )
+        timestamps = [updated_at for version, updated_at in rows.values() if updated_at]
+
+        versions = []
+        for name in names:
+            version = str(rows.get(name, (0, None))[0])
+            if name in EVENT_DERIVED_RESOURCES:
+                oldest_id, newest_id, count, newest_at = DataVersions.event_state()
+                version += f':{oldest_id or 0}:{newest_id or 0}:{count}'
+                if newest_at:
+                    timestamps.append(newest_at)
+            versions.append(version)
+
+        query_hash = zlib.crc32(request.query_string)
+        return f"{'.'.join(versions)}-{query_hash:08x}", max(timestamps) if timestamps else None
+
+def conditional(*names):
+    """Answer GET requests with 304 while the named resources are unchanged.
+
+    The check runs before the view, so an unchanged list costs one small
+    query instead of the full query and serialisation.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method != 'GET':
+                return view(*args, **kwargs)
+
+            etag, last_modified = DataVersions.validators(*names)
+            if not is_resource_modified(request.environ, etag=f'W/"{etag}"', last_modified=last_modified):
+                response = Response(status=304)
+            else:
+                response = view(*args, **kwargs)
+                if isinstance(response, tuple) or response.status_code != 200:
+                    return response
+
+            response.set_etag(etag, weak=True)
+            if last_modified:
+                response.last_modified = last_modified
+            # Browsers keep the body but revalidate it on every request
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+            return response
+        return wrapper
+    return decorator
@@ -1,3 +1,103 @@
+import importlib
+import os
+import sqlite3
+from functools import wraps
+from flask import g, has_request_context, request
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+from sqlalchemy.engine import Engine, make_url
 
-db = SQLAlchemy()
\ No newline at end of file
+# 読み取り専用エンドポイントのSELECTを送るレプリカのバインド名（DATABASE_REPLICA_URL）
+REPLICA_BIND = 'replica'
+
+class RoutingSession(Session):
+    """Sends SELECTs to the read replica inside views marked with replica_reads"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if (bind is None
+                and clause is not None
+                and not self._flushing
+                and not getattr(clause, 'is_dml', False)
+                and has_request_context() and g.get('read_replica')
+                and REPLICA_BIND in self._db.engines):
+            return self._db.engines[REPLICA_BIND]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+
+def replica_reads(view):
+    """Serve GET requests of a read-only view from the replica when one is configured.
+
+    Writes and every other request keep using the primary. The replica may lag
+    a little behind; use it only for lists and reports, never before a write.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.method == 'GET':
+            g.read_replica = True
+        return view(*args, **kwargs)
+    return wrapper
+
+# SQLite の同時アクセス設定
+SQLITE_JOURNAL_MODE = os.getenv('SQLITE_JOURNAL_MODE', 'WAL')
+SQLITE_SYNCHRONOUS = os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL')
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', '5000'))
+
+# PostgreSQL の文タイムアウト（ミリ秒、0 で無効）
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv('DB_STATEMENT_TIMEOUT_MS', '0'))
+
+def database_url(url):
+    """Normalise a database URL; postgres:// (as issued by some hosts) becomes postgresql://"""
+    if url.startswith('postgres://'):
+        return 'postgresql://' + url[len('postgres://'):]
+    return url
+
+def sqlite_directory(url):
+    """Directory of a SQLite database file, or None for other databases and in-memory SQLite"""
+    parsed = make_url(url)
+    if parsed.get_backend_name() != 'sqlite' or parsed.database in (None, '', ':memory:'):
+        return None
+    return os.path.dirname(parsed.database) or None
+
+def engine_options(database_url):
+    """SQLAlchemy engine options for the configured database"""
+    options = {'pool_pre_ping': True}
+    if not database_url.startswith('sqlite'):
+        # Pool per worker process: size it to the gunicorn threads, overflow for bursts
+        options.update({
+            'pool_size': int(os.getenv('DB_POOL_SIZE', '5')),
+            'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', '10')),
+            'pool_timeout': int(os.getenv('DB_POOL_TIMEOUT', '30')),
+            'pool_recycle': int(os.getenv('DB_POOL_RECYCLE', '1800'))
+        })
+    if database_url.startswith('postgresql'):
+        connect_args = {'application_name': os.getenv('DB_APPLICATION_NAME', 'attendance')}
+        if DB_STATEMENT_TIMEOUT_MS:
+            connect_args['options'] = f'-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}'
+        options['connect_args'] = connect_args
+    return options
+
+@event.listens_for(Engine, 'connect')
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    """WAL lets readers run while a scan is being written; busy_timeout waits for the write lock instead of failing"""
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f'PRAGMA journal_mode={SQLITE_JOURNAL_MODE}')
+    cursor.execute(f'PRAGMA synchronous={SQLITE_SYNCHRONOUS}')
+    cursor.execute(f'PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}')
+    cursor.close()
+
+# 方言ごとの INSERT ... ON CONFLICT 実装（使う方言のモジュールだけを初回に import する）
+UPSERT_INSERTS = {
+    'sqlite': 'sqlalchemy.dialects.sqlite',
+    'postgresql': 'sqlalchemy.dialects.postgresql',
+}
+
+def upsert_insert(table, bind=None):
+    """Return an INSERT supporting on_conflict_do_update for the current database"""
+    dialect = (bind or db.session.get_bind()).dialect.name
+    if dialect not in UPSERT_INSERTS:
+        raise NotImplementedError(f"Upsert is not supported for {dialect}")
+    return importlib.import_module(UPSERT_INSERTS[dialect]).insert(table)
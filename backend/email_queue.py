@@ -0,0 +1,192 @@
+import os
+import signal
+import threading
+from datetime import datetime, timedelta
+import click
+from sqlalchemy import func, insert, update
+from database import db
+from models import EmailJob
+from qr_service import QRService, SMTPConfig, open_mail_session
+
+# 送信リトライ設定
+EMAIL_MAX_ATTEMPTS = int(os.getenv('EMAIL_MAX_ATTEMPTS', '5'))
+EMAIL_RETRY_BASE_SECONDS = float(os.getenv('EMAIL_RETRY_BASE_SECONDS', '30'))
+EMAIL_RETRY_MAX_SECONDS = float(os.getenv('EMAIL_RETRY_MAX_SECONDS', '3600'))
+EMAIL_POLL_INTERVAL = float(os.getenv('EMAIL_POLL_INTERVAL', '5'))
+# この時間 'sending' のままのジョブは送信中にプロセスが落ちたものとして再キューする
+EMAIL_STALE_SENDING_SECONDS = float(os.getenv('EMAIL_STALE_SENDING_SECONDS', '600'))
+
+JOB_STATUSES = ('queued', 'sending', 'sent', 'failed')
+
+_worker = None
+
+class EmailQueue:
+    @staticmethod
+    def enqueue(user, date):
+        """Queue a QR code email for a user; the caller commits"""
+        job = EmailJob(user_id=user.id, to_email=user.email, user_name=user.name, date=date)
+        db.session.add(job)
+        return job
+
+    @staticmethod
+    def enqueue_many(users, date):
+        """Queue a QR code email for each user in one multi-row INSERT; returns the job ids, the caller commits"""
+        if not users:
+            return []
+        rows = [{'user_id': user.id, 'to_email': user.email, 'user_name': user.name, 'date': date} for user in users]
+        stmt = insert(EmailJob).returning(EmailJob.id, sort_by_parameter_order=True)
+        return list(db.session.scalars(stmt, rows))
+
+    @staticmethod
+    def counts():
+        """Number of jobs per status"""
+        rows = db.session.query(EmailJob.status, func.count(EmailJob.id)).group_by(EmailJob.status).all()
+        counts = {status: 0 for status in JOB_STATUSES}
+        counts.update(dict(rows))
+        return counts
+
+    @staticmethod
+    def retry_delay(attempts):
+        """Exponential backoff after the given number of failed attempts"""
+        return min(EMAIL_RETRY_BASE_SECONDS * (2 ** (attempts - 1)), EMAIL_RETRY_MAX_SECONDS)
+
+    @staticmethod
+    def requeue_stale():
+        """Put back jobs left in 'sending' by a worker that died mid-send"""
+        cutoff = datetime.utcnow() - timedelta(seconds=EMAIL_STALE_SENDING_SECONDS)
+        result = db.session.execute(
+            update(EmailJob)
+            .where(EmailJob.status == 'sending', EmailJob.updated_at < cutoff)
+            .values(status='queued', next_attempt_at=datetime.utcnow())
+        )
+        db.session.commit()
+        return result.rowcount
+
+    @staticmethod
+    def claim_next():
+        """Atomically take the next due job, or return None when nothing is due"""
+        while True:
+            job_id = db.session.query(EmailJob.id).filter(
+                EmailJob.status == 'queued',
+                EmailJob.next_attempt_at <= datetime.utcnow()
+            ).order_by(EmailJob.next_attempt_at, EmailJob.id).limit(1).scalar()
+            if job_id is None:
+                db.session.commit()
+                return None
+
+            # Another worker process may claim the same job; only one UPDATE matches
+            result = db.session.execute(
+                update(EmailJob)
+                .where(EmailJob.id == job_id, EmailJob.status == 'queued')
+                .values(status='sending', attempts=EmailJob.attempts + 1, updated_at=datetime.utcnow())
+            )
+            db.session.commit()
+            if result.rowcount == 1:
+                return db.session.get(EmailJob, job_id)
+
+
+class EmailWorker(threading.Thread):
+    """Background thread that drains the email job queue"""
+
+    def __init__(self, app):
+        super().__init__(name='email-worker', daemon=True)
+        self.app = app
+        self._wakeup = threading.Event()
+        self._stopping = False
+
+    def wake(self):
+        self._wakeup.set()
+
+    def stop(self):
+        self._stopping = True
+        self._wakeup.set()
+
+    def run(self):
+        with self.app.app_context():
+            try:
+                requeued = EmailQueue.requeue_stale()
+                if requeued:
+                    print(f"Requeued {requeued} interrupted email jobs")
+            except Exception as e:
+                db.session.rollback()
+                print(f"Error requeuing email jobs: {e}")
+
+            while not self._stopping:
+                try:
+                    self.drain()
+                except Exception as e:
+                    db.session.rollback()
+                    print(f"Email worker error: {e}")
+                finally:
+                    db.session.remove()
+                self._wakeup.wait(EMAIL_POLL_INTERVAL)
+                self._wakeup.clear()
+
+    def drain(self):
+        """Send every due job, reusing one SMTP connection until the queue is empty"""
+        smtp = None
+        try:
+            while not self._stopping:
+                job = EmailQueue.claim_next()
+                if job is None:
+                    return
+
+                try:
+                    if smtp is None:
+                        smtp = open_mail_session(SMTPConfig.from_env())
+                    qr_image_io, qr_data = QRService.generate_qr_code(job.user_id, job.date)
+                    msg = QRService.build_qr_message(
+                        job.to_email, job.user_name, qr_image_io, job.date, smtp.config.from_email
+                    )
+                    smtp.send(msg)
+                    job.status = 'sent'
+                    job.last_error = None
+                except Exception as e:
+                    print(f"Error sending email job {job.id} (attempt {job.attempts}): {e}")
+                    job.last_error = str(e)
+                    if job.attempts >= EMAIL_MAX_ATTEMPTS:
+                        job.status = 'failed'
+                    else:
+                        job.status = 'queued'
+                        job.next_attempt_at = datetime.utcnow() + timedelta(
+                            seconds=EmailQueue.retry_delay(job.attempts)
+                        )
+                    # Drop a connection that may be in a broken state
+                    if smtp is not None:
+                        smtp.close()
+                db.session.commit()
+        finally:
+            if smtp is not None:
+                smtp.close()
+
+
+def start_email_worker(app):
+    """Start the background email worker in a thread of this process (development server)"""
+    global _worker
+    if _worker is None:
+        _worker = EmailWorker(app)
+        _worker.start()
+    return _worker
+
+
+def notify_email_worker():
+    """Wake the worker so a freshly queued job is sent without waiting for the next poll"""
+    if _worker is not None:
+        _worker.wake()
+
+
+def register_email_commands(app):
+    """メール送信ワーカーのCLIコマンドを登録"""
+
+    @app.cli.command('email-worker')
+    def email_worker_command():
+        """Send queued emails until stopped; run exactly one, so SMTP_RATE_LIMIT holds."""
+        worker = EmailWorker(app)
+        # docker stop: finish the message being sent, then exit
+        signal.signal(signal.SIGTERM, lambda signum, frame: worker.stop())
+        click.echo("Email worker started")
+        try:
+            worker.run()
+        except KeyboardInterrupt:
+            pass
+        click.echo("Email worker stopped")
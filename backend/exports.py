@@ -0,0 +1,85 @@
+import csv
+import io
+import json
+from flask import request, jsonify, Response, stream_with_context
+from sqlalchemy import select
+from database import db, replica_reads
+from models import User, Attendance
+from attendance_service import AttendanceService
+from serializers import attendance_columns, attendance_dict, isoformat
+from archive import AttendanceArchive
+
+# サーバーサイドカーソルから一度に取り出す行数
+EXPORT_YIELD_PER = 1000
+
+CSV_HEADER = ['id', 'date', 'user_id', 'user_name', 'user_email', 'check_in', 'check_out', 'created_at']
+
+def register_export_routes(app):
+    """エクスポート関連のルートを登録"""
+
+    @app.route('/api/attendance/export', methods=['GET'])
+    @replica_reads
+    def export_attendance():
+        export_format = request.args.get('format', 'csv')
+        if export_format not in ('csv', 'ndjson'):
+            return jsonify({'error': 'Unsupported export format'}), 400
+
+        user_id = request.args.get('user_id')
+        start_date = request.args.get('start_date')
+        end_date = request.args.get('end_date')
+        try:
+            AttendanceService.filters(user_id, start_date, end_date)
+            # Archive years are only read when the date range reaches back that far
+            tables = [Attendance.__table__] + AttendanceArchive.tables(start_date, end_date)
+        except ValueError:
+            return jsonify({'error': 'Invalid date format'}), 400
+
+        def rows():
+            # Live rows, then archive years newest first: one date-descending sequence
+            for table in tables:
+                # Plain column tuples streamed in chunks: no ORM objects, no full result list
+                query = select(*attendance_columns(table)).join_from(
+                    table, User, table.c.user_id == User.id
+                ).where(*AttendanceService.filters(user_id, start_date, end_date, table)).order_by(
+                    table.c.date.desc(), table.c.id.desc()
+                ).execution_options(yield_per=EXPORT_YIELD_PER)
+                yield from db.session.execute(query)
+
+        def generate_csv():
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            # BOM so spreadsheet software detects UTF-8 names
+            buffer.write('\ufeff')
+            writer.writerow(CSV_HEADER)
+            for row_count, row in enumerate(rows(), 1):
+                (attendance_id, user_id, check_in, check_out, target_date, created_at,
+                 user_name, user_email, user_department, user_created_at) = row
+                writer.writerow([
+                    attendance_id, isoformat(target_date), user_id, user_name, user_email,
+                    isoformat(check_in), isoformat(check_out), isoformat(created_at)
+                ])
+                if row_count % EXPORT_YIELD_PER == 0:
+                    yield buffer.getvalue()
+                    buffer.seek(0)
+                    buffer.truncate()
+            yield buffer.getvalue()
+
+        def generate_ndjson():
+            lines = []
+            for row in rows():
+                # Same shape as the items of /api/attendance
+                lines.append(json.dumps(attendance_dict(row), ensure_ascii=False, sort_keys=True))
+                if len(lines) >= EXPORT_YIELD_PER:
+                    yield '\n'.join(lines) + '\n'
+                    lines = []
+            if lines:
+                yield '\n'.join(lines) + '\n'
+
+        if export_format == 'csv':
+            body, mimetype = generate_csv(), 'text/csv'
+        else:
+            body, mimetype = generate_ndjson(), 'application/x-ndjson'
+
+        response = Response(stream_with_context(body), mimetype=mimetype)
+        response.headers['Content-Disposition'] = f'attachment; filename=attendance.{export_format}'
+        return response
@@ -1,64 +1,173 @@
 import os
 import json
-import requests
+import base64
+import threading
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+import requests
+from requests.adapters import HTTPAdapter
+from metrics import metrics
+from qr_service import RateLimiter
+
+try:
+    import fcntl
+except ImportError:  # Windows: only threads of this process are serialised
+    fcntl = None
+
+# OAuth / Gmail API のエンドポイント（テスト用スタブサーバーに向けられるよう環境変数で上書き可能）
+GMAIL_AUTH_URL = os.getenv('GMAIL_AUTH_URL', 'https://accounts.google.com/o/oauth2/auth')
+GMAIL_TOKEN_URL = os.getenv('GMAIL_TOKEN_URL', 'https://oauth2.googleapis.com/token')
+GMAIL_API_URL = os.getenv('GMAIL_API_URL', 'https://gmail.googleapis.com')
+
+# 全ワーカープロセスで共有するトークンの保存先（空にするとプロセス内のみ）
+GMAIL_TOKEN_FILE = os.getenv('GMAIL_TOKEN_FILE', '/data/gmail_token.json')
+
+GMAIL_HTTP_TIMEOUT = float(os.getenv('GMAIL_HTTP_TIMEOUT', '30'))
+
+# 有効期限の何秒前からリフレッシュするか
+TOKEN_REFRESH_MARGIN = timedelta(minutes=5)
+
+# 接続を使い回すHTTPセッション（スレッド間で共有）
+GMAIL_HTTP_POOL_SIZE = int(os.getenv('GMAIL_HTTP_POOL_SIZE', '8'))
+http_session = requests.Session()
+http_session.mount('https://', HTTPAdapter(pool_maxsize=GMAIL_HTTP_POOL_SIZE))
+http_session.mount('http://', HTTPAdapter(pool_maxsize=GMAIL_HTTP_POOL_SIZE))
+
+_refresh_lock = threading.Lock()
+# Tokens already read by this process, so a valid token costs no file access
+_token_cache = {}
+
+def _is_valid(tokens):
+    try:
+        expiry = datetime.fromisoformat(tokens['token_expiry'])
+    except (KeyError, TypeError, ValueError):
+        return False
+    return bool(tokens.get('access_token')) and datetime.now() < expiry - TOKEN_REFRESH_MARGIN
+
+class TokenStore:
+    """アクセストークンのファイル保存（書き込みはアトミック、リフレッシュはファイルロックで1プロセスのみ）"""
+
+    def __init__(self, path=GMAIL_TOKEN_FILE):
+        self.path = path
+
+    def load(self):
+        if not self.path:
+            return dict(_token_cache.get(self.path, {}))
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                tokens = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        _token_cache[self.path] = tokens
+        return dict(tokens)
+
+    def save(self, tokens):
+        _token_cache[self.path] = dict(tokens)
+        if not self.path:
+            return
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        # The file holds the refresh token: owner read/write only
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(tokens, f)
+        os.replace(tmp_path, self.path)
+
+    def cached(self):
+        """Tokens this process last read or wrote, without touching the file"""
+        return dict(_token_cache.get(self.path, {}))
+
+    @contextmanager
+    def lock(self):
+        """Serialise refreshes across threads and, through flock, across worker processes"""
+        with _refresh_lock:
+            if not self.path or fcntl is None:
+                yield
+                return
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            with open(f'{self.path}.lock', 'w') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
 
 class GmailAuthService:
     """Gmail API認証管理サービス"""
     
-    def __init__(self):
+    def __init__(self, store=None):
         self.client_id = os.getenv('GMAIL_CLIENT_ID')
         self.client_secret = os.getenv('GMAIL_CLIENT_SECRET')
-        self.refresh_token = os.getenv('GMAIL_REFRESH_TOKEN')
-        self.access_token = os.getenv('GMAIL_ACCESS_TOKEN')
-        self.token_expiry = os.getenv('GMAIL_TOKEN_EXPIRY')
+        self.store = store or TokenStore()
         
+        # 初回は環境変数のトークンを保存先に取り込む
+        tokens = self.store.load()
+        if not tokens.get('refresh_token') and os.getenv('GMAIL_REFRESH_TOKEN'):
+            self.store.save({
+                'access_token': os.getenv('GMAIL_ACCESS_TOKEN'),
+                'token_expiry': os.getenv('GMAIL_TOKEN_EXPIRY'),
+                'refresh_token': os.getenv('GMAIL_REFRESH_TOKEN')
+            })
+    
+    @staticmethod
+    def is_configured():
+        return bool(os.getenv('GMAIL_CLIENT_ID') and os.getenv('GMAIL_CLIENT_SECRET'))
+    
     def get_valid_access_token(self):
         """有効なアクセストークンを取得"""
-        # アクセストークンが存在し、まだ有効期限内かチェック
-        if self.access_token and self.token_expiry:
-            try:
-                expiry_time = datetime.fromisoformat(self.token_expiry)
-                if datetime.now() < expiry_time - timedelta(minutes=5):  # 5分の余裕を持つ
-                    return self.access_token
-            except:
-                pass
+        # このプロセスが既に持っているトークン → 他プロセスが保存したトークン → リフレッシュ
+        tokens = self.store.cached()
+        if _is_valid(tokens):
+            return tokens['access_token']
+        
+        tokens = self.store.load()
+        if _is_valid(tokens):
+            return tokens['access_token']
         
-        # トークンをリフレッシュ
         return self.refresh_access_token()
     
-    def refresh_access_token(self):
-        """リフレッシュトークンを使用してアクセストークンを更新"""
-        if not all([self.client_id, self.client_secret, self.refresh_token]):
-            raise ValueError("Gmail API credentials not properly configured")
+    def refresh_access_token(self, stale_token=None):
+        """リフレッシュトークンを使用してアクセストークンを更新
         
-        url = 'https://oauth2.googleapis.com/token'
-        data = {
-            'client_id': self.client_id,
-            'client_secret': self.client_secret,
-            'refresh_token': self.refresh_token,
-            'grant_type': 'refresh_token'
-        }
-        
-        try:
-            response = requests.post(url, data=data)
-            response.raise_for_status()
+        stale_token は拒否されたトークン。ロック待ちの間に別のプロセスが
+        リフレッシュ済みなら、その結果を使い二重にリフレッシュしない。
+        """
+        with self.store.lock():
+            tokens = self.store.load()
+            if _is_valid(tokens) and tokens['access_token'] != stale_token:
+                return tokens['access_token']
             
-            token_data = response.json()
-            new_access_token = token_data['access_token']
-            expires_in = token_data.get('expires_in', 3600)
+            refresh_token = tokens.get('refresh_token') or os.getenv('GMAIL_REFRESH_TOKEN')
+            if not all([self.client_id, self.client_secret, refresh_token]):
+                raise ValueError("Gmail API credentials not properly configured")
             
-            # 新しいトークンの有効期限を計算
-            expiry_time = datetime.now() + timedelta(seconds=expires_in)
+            data = {
+                'client_id': self.client_id,
+                'client_secret': self.client_secret,
+                'refresh_token': refresh_token,
+                'grant_type': 'refresh_token'
+            }
             
-            # 環境変数を更新（実際のアプリケーションでは適切な方法で保存）
-            os.environ['GMAIL_ACCESS_TOKEN'] = new_access_token
-            os.environ['GMAIL_TOKEN_EXPIRY'] = expiry_time.isoformat()
-            
-            return new_access_token
+            try:
+                with metrics.timer('gmail_token_refresh_seconds', help_text='Gmail OAuth token refresh time'):
+                    response = http_session.post(GMAIL_TOKEN_URL, data=data, timeout=GMAIL_HTTP_TIMEOUT)
+                response.raise_for_status()
+                
+                token_data = response.json()
+                expires_in = token_data.get('expires_in', 3600)
+                
+                # 新しいトークンの有効期限を計算し、全プロセスで共有する
+                self.store.save({
+                    'access_token': token_data['access_token'],
+                    'token_expiry': (datetime.now() + timedelta(seconds=expires_in)).isoformat(),
+                    # Google may rotate the refresh token
+                    'refresh_token': token_data.get('refresh_token') or refresh_token
+                })
+                
+                return token_data['access_token']
             
-        except requests.exceptions.RequestException as e:
-            raise Exception(f"Failed to refresh access token: {e}")
+            except requests.exceptions.RequestException as e:
+                raise Exception(f"Failed to refresh access token: {e}")
     
     @staticmethod
     def get_authorization_url():
@@ -72,7 +181,7 @@ class GmailAuthService:
         scope = 'https://www.googleapis.com/auth/gmail.send'
         
         auth_url = (
-            f"https://accounts.google.com/o/oauth2/auth?"
+            f"{GMAIL_AUTH_URL}?"
             f"client_id={client_id}&"
             f"redirect_uri={redirect_uri}&"
             f"scope={scope}&"
@@ -84,7 +193,7 @@ class GmailAuthService:
         return auth_url
     
     @staticmethod
-    def exchange_code_for_tokens(authorization_code):
+    def exchange_code_for_tokens(authorization_code, store=None):
         """認証コードをアクセストークンとリフレッシュトークンに交換"""
         client_id = os.getenv('GMAIL_CLIENT_ID')
         client_secret = os.getenv('GMAIL_CLIENT_SECRET')
@@ -93,7 +202,6 @@ class GmailAuthService:
         if not all([client_id, client_secret]):
             raise ValueError("Gmail API credentials not configured")
         
-        url = 'https://oauth2.googleapis.com/token'
         data = {
             'client_id': client_id,
             'client_secret': client_secret,
@@ -103,20 +211,60 @@ class GmailAuthService:
         }
         
         try:
-            response = requests.post(url, data=data)
+            response = http_session.post(GMAIL_TOKEN_URL, data=data, timeout=GMAIL_HTTP_TIMEOUT)
             response.raise_for_status()
             
             token_data = response.json()
             
-            # トークンを環境変数に保存
-            os.environ['GMAIL_ACCESS_TOKEN'] = token_data['access_token']
-            os.environ['GMAIL_REFRESH_TOKEN'] = token_data.get('refresh_token', '')
-            
-            expires_in = token_data.get('expires_in', 3600)
-            expiry_time = datetime.now() + timedelta(seconds=expires_in)
-            os.environ['GMAIL_TOKEN_EXPIRY'] = expiry_time.isoformat()
+            # トークンを共有の保存先に保存
+            store = store or TokenStore()
+            with store.lock():
+                expires_in = token_data.get('expires_in', 3600)
+                store.save({
+                    'access_token': token_data['access_token'],
+                    'token_expiry': (datetime.now() + timedelta(seconds=expires_in)).isoformat(),
+                    'refresh_token': token_data.get('refresh_token') or store.load().get('refresh_token')
+                })
             
             return token_data
-            
+        
         except requests.exceptions.RequestException as e:
-            raise Exception(f"Failed to exchange authorization code: {e}")
\ No newline at end of file
+            raise Exception(f"Failed to exchange authorization code: {e}")
+
+
+class GmailAPISession:
+    """SMTPSession と同じ使い方で Gmail API 経由で送信する（HTTP接続とトークンを再利用）"""
+
+    def __init__(self, config, auth=None):
+        self.config = config
+        self.auth = auth or GmailAuthService()
+        self._rate_limiter = RateLimiter(config.rate_limit)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        # Pooled connections stay open for the next session
+        pass
+
+    def send(self, msg):
+        """Send a message, refreshing the token once if the API rejects it"""
+        raw = base64.urlsafe_b64encode(msg.as_bytes()).decode('ascii')
+        url = f'{GMAIL_API_URL}/gmail/v1/users/me/messages/send'
+
+        self._rate_limiter.wait()
+        token = self.auth.get_valid_access_token()
+        for attempt in range(2):
+            with metrics.timer('gmail_send_seconds', help_text='Gmail API message send time'):
+                response = http_session.post(
+                    url, json={'raw': raw}, headers={'Authorization': f'Bearer {token}'},
+                    timeout=GMAIL_HTTP_TIMEOUT
+                )
+            if response.status_code == 401 and attempt == 0:
+                token = self.auth.refresh_access_token(stale_token=token)
+                continue
+            response.raise_for_status()
+            return response.json()
@@ -0,0 +1,207 @@
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from flask import g, has_request_context, request, Response
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# 遅いリクエストのログ（ミリ秒、未設定なら無効）
+SLOW_REQUEST_MS = float(os.getenv('SLOW_REQUEST_MS', '0'))
+SLOW_REQUEST_MAX_STATEMENTS = 20
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+slow_request_log = logging.getLogger('slow_requests')
+
+
+class Histogram:
+    """Cumulative-bucket histogram in the Prometheus style"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+class MetricsRegistry:
+    """Process-local metrics; each worker process exposes its own values"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+        self._help = {}
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, help_text=None, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+            if help_text:
+                self._help.setdefault(name, help_text)
+
+    def inc(self, name, amount=1, help_text=None, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+            if help_text:
+                self._help.setdefault(name, help_text)
+
+    @contextmanager
+    def timer(self, name, help_text=None, **labels):
+        """Observe the duration of the with-block in seconds"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, help_text=help_text, **labels)
+
+    def render(self, extra=()):
+        """Render all metrics in the Prometheus text exposition format.
+
+        extra holds (name, type, help, [(labels, value), ...]) for values
+        sampled at scrape time, such as cache statistics.
+        """
+        lines = []
+        with self._lock:
+            for name, series in _group(self._counters).items():
+                lines.extend(self._header(name, 'counter'))
+                for labels, value in series:
+                    lines.append(f'{name}{_labels(labels)} {value}')
+
+            for name, series in _group(self._histograms).items():
+                lines.extend(self._header(name, 'histogram'))
+                for labels, histogram in series:
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        lines.append(f'{name}_bucket{_labels(labels + (("le", format(bound, "g")),))} {count}')
+                    lines.append(f'{name}_bucket{_labels(labels + (("le", "+Inf"),))} {histogram.count}')
+                    lines.append(f'{name}_sum{_labels(labels)} {histogram.sum}')
+                    lines.append(f'{name}_count{_labels(labels)} {histogram.count}')
+
+        for name, metric_type, help_text, series in extra:
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            for labels, value in series:
+                lines.append(f'{name}{_labels(tuple(sorted(labels.items())))} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+    def _header(self, name, metric_type):
+        header = []
+        if name in self._help:
+            header.append(f'# HELP {name} {self._help[name]}')
+        header.append(f'# TYPE {name} {metric_type}')
+        return header
+
+
+def _group(metrics):
+    grouped = {}
+    for (name, labels), value in sorted(metrics.items()):
+        grouped.setdefault(name, []).append((labels, value))
+    return grouped
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels) + '}'
+
+
+metrics = MetricsRegistry()
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_started'].pop()
+    metrics.observe('db_query_duration_seconds', elapsed, help_text='SQL statement execution time')
+
+    # Attribute the statement to the current request, if any
+    if has_request_context() and 'metrics_started' in g:
+        g.metrics_query_count += 1
+        g.metrics_query_time += elapsed
+        if SLOW_REQUEST_MS and len(g.metrics_statements) < SLOW_REQUEST_MAX_STATEMENTS:
+            g.metrics_statements.append((elapsed, statement))
+
+
+def register_metrics(app):
+    """リクエスト計測フックと /api/metrics を登録"""
+
+    @app.before_request
+    def start_request_metrics():
+        g.metrics_started = time.perf_counter()
+        g.metrics_query_count = 0
+        g.metrics_query_time = 0.0
+        g.metrics_statements = []
+
+    @app.after_request
+    def record_request_metrics(response):
+        if 'metrics_started' not in g:
+            return response
+
+        elapsed = time.perf_counter() - g.metrics_started
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.observe('http_request_duration_seconds', elapsed,
+                        help_text='Request latency by endpoint',
+                        method=request.method, endpoint=endpoint, status=response.status_code)
+        metrics.observe('db_queries_per_request', g.metrics_query_count, buckets=COUNT_BUCKETS,
+                        help_text='SQL statements issued per request',
+                        method=request.method, endpoint=endpoint)
+        metrics.observe('db_time_per_request_seconds', g.metrics_query_time,
+                        help_text='Time spent in SQL per request',
+                        method=request.method, endpoint=endpoint)
+
+        if SLOW_REQUEST_MS and elapsed * 1000.0 >= SLOW_REQUEST_MS:
+            statements = '\n'.join(
+                f'  {query_time * 1000.0:.1f}ms {statement}' for query_time, statement in g.metrics_statements
+            )
+            slow_request_log.warning(
+                'Slow request %s %s -> %s in %.1fms (%d queries, %.1fms in SQL)\n%s',
+                request.method, request.full_path, response.status_code, elapsed * 1000.0,
+                g.metrics_query_count, g.metrics_query_time * 1000.0, statements
+            )
+        return response
+
+    @app.route('/api/metrics', methods=['GET'])
+    def metrics_endpoint():
+        from attendance_service import user_cache
+        from qr_service import qr_png_cache
+        from email_queue import EmailQueue
+
+        caches = (('user_lookup', user_cache.stats()), ('qr_png', qr_png_cache.stats()))
+        extra = [
+            (f'cache_{field}', metric_type, f'In-process cache {field}',
+             [({'cache': cache_name}, stats[field]) for cache_name, stats in caches])
+            for field, metric_type in (('hits', 'counter'), ('misses', 'counter'),
+                                       ('evictions', 'counter'), ('size', 'gauge'))
+        ]
+        try:
+            extra.append(('email_jobs', 'gauge', 'Email jobs by status', [
+                ({'status': status}, count) for status, count in EmailQueue.counts().items()
+            ]))
+        except Exception as e:
+            print(f"Error reading email job counts: {e}")
+
+        body = metrics.render(extra)
+        return Response(body, mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,136 @@
+import os
+import time
+from contextlib import contextmanager
+import click
+from flask import current_app
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import OperationalError
+from database import db, sqlite_directory
+
+# pg_advisory_lock のキー（マイグレーション用）
+MIGRATION_LOCK_KEY = 7283001
+
+# init-db がデータベースへの接続を待つ最大時間（秒）。コンテナ起動直後の PostgreSQL 用
+DB_INIT_WAIT_SECONDS = int(os.getenv('DB_INIT_WAIT_SECONDS', '60'))
+
+
+def _attendance_indexes(conn):
+    """Add the (user_id, date) unique index and the date index to attendance"""
+    # Merge duplicate check-ins left behind by concurrent scans before enforcing uniqueness
+    conn.execute(text("""
+        UPDATE attendance SET
+            check_in = (SELECT MIN(a.check_in) FROM attendance a
+                        WHERE a.user_id = attendance.user_id AND a.date = attendance.date),
+            check_out = (SELECT MAX(a.check_out) FROM attendance a
+                         WHERE a.user_id = attendance.user_id AND a.date = attendance.date)
+        WHERE id IN (SELECT MIN(id) FROM attendance GROUP BY user_id, date HAVING COUNT(*) > 1)
+    """))
+    conn.execute(text("""
+        DELETE FROM attendance
+        WHERE id NOT IN (SELECT MIN(id) FROM attendance GROUP BY user_id, date)
+    """))
+    conn.execute(text(
+        'CREATE UNIQUE INDEX IF NOT EXISTS uq_attendance_user_date ON attendance (user_id, date)'
+    ))
+    conn.execute(text('CREATE INDEX IF NOT EXISTS ix_attendance_date ON attendance (date)'))
+
+
+def _user_department(conn):
+    """Add user.department used by the report filters"""
+    columns = {column['name'] for column in inspect(conn).get_columns('user')}
+    if 'department' not in columns:
+        conn.execute(text('ALTER TABLE "user" ADD COLUMN department VARCHAR(100)'))
+    conn.execute(text('CREATE INDEX IF NOT EXISTS ix_user_department ON "user" (department)'))
+
+
+def _backfill_rollups(conn):
+    """Fill the attendance rollup tables from existing attendance history"""
+    from rollups import RollupService
+    RollupService.rebuild(conn)
+
+
+def _seed_data_versions(conn):
+    """Create the change counters read by the conditional GET endpoints"""
+    from data_version import TRACKED_RESOURCES
+    for name in TRACKED_RESOURCES:
+        conn.execute(text(
+            'INSERT INTO data_version (name, version, updated_at) '
+            'SELECT :name, 1, CURRENT_TIMESTAMP WHERE NOT EXISTS (SELECT 1 FROM data_version WHERE name = :name)'
+        ), {'name': name})
+
+
+# (version, description, step) — append new steps, never reorder or edit applied ones
+MIGRATIONS = [
+    (1, 'attendance indexes', _attendance_indexes),
+    (2, 'user department', _user_department),
+    (3, 'attendance rollups', _backfill_rollups),
+    (4, 'data versions', _seed_data_versions),
+]
+
+
+@contextmanager
+def _migration_lock():
+    """On PostgreSQL, let only one worker process create tables and migrate at a time"""
+    if db.engine.dialect.name != 'postgresql':
+        yield
+        return
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        conn.execute(text('SELECT pg_advisory_lock(:key)'), {'key': MIGRATION_LOCK_KEY})
+        try:
+            yield
+        finally:
+            conn.execute(text('SELECT pg_advisory_unlock(:key)'), {'key': MIGRATION_LOCK_KEY})
+
+
+def upgrade_database():
+    """Create missing tables and apply pending migrations to an existing database"""
+    with _migration_lock():
+        # New tables (and their indexes) are created directly from the models
+        db.create_all()
+
+        with db.engine.begin() as conn:
+            conn.execute(text('CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)'))
+            current = conn.execute(text('SELECT MAX(version) FROM schema_version')).scalar() or 0
+
+            for version, description, step in MIGRATIONS:
+                if version <= current:
+                    continue
+                step(conn)
+                conn.execute(text('INSERT INTO schema_version (version) VALUES (:version)'), {'version': version})
+                print(f"Applied migration {version}: {description}")
+
+
+def wait_for_database(timeout):
+    """Retry connecting until the database accepts connections or timeout seconds have passed"""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            with db.engine.connect() as conn:
+                conn.execute(text('SELECT 1'))
+            return
+        except OperationalError as e:
+            if time.monotonic() >= deadline:
+                raise
+            print(f"Waiting for database: {e.orig}")
+            time.sleep(1)
+
+
+def init_database():
+    """Create the SQLite directory, the tables and apply pending migrations"""
+    directory = sqlite_directory(current_app.config['SQLALCHEMY_DATABASE_URI'])
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    upgrade_database()
+
+
+def register_migration_commands(app):
+    """データベース初期化のCLIコマンドを登録"""
+
+    @app.cli.command('init-db')
+    @click.option('--wait', 'wait_seconds', type=int, default=DB_INIT_WAIT_SECONDS, show_default=True,
+                  help='Seconds to wait for the database to accept connections')
+    def init_db_command(wait_seconds):
+        """Create tables and apply migrations; run once before starting the workers."""
+        wait_for_database(wait_seconds)
+        init_database()
+        click.echo("Database tables created successfully")
@@ -5,18 +5,28 @@ class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False, unique=True)
     email = db.Column(db.String(100), nullable=False, unique=True)
+    department = db.Column(db.String(100), index=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     attendances = db.relationship('Attendance', backref='user', lazy=True, cascade='all, delete-orphan')
+    daily_rollups = db.relationship('DailyAttendanceRollup', lazy=True, cascade='all, delete-orphan')
+    monthly_rollups = db.relationship('MonthlyAttendanceRollup', lazy=True, cascade='all, delete-orphan')
 
     def to_dict(self):
         return {
             'id': self.id,
             'name': self.name,
             'email': self.email,
+            'department': self.department,
             'created_at': self.created_at.isoformat() if self.created_at else None
         }
 
 class Attendance(db.Model):
+    # (user_id, date) は打刻時の検索キーであり、1日1レコードを保証する一意インデックスを兼ねる
+    __table_args__ = (
+        db.Index('uq_attendance_user_date', 'user_id', 'date', unique=True),
+        db.Index('ix_attendance_date', 'date'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     check_in = db.Column(db.DateTime)
@@ -32,4 +42,120 @@ class Attendance(db.Model):
             'check_out': self.check_out.isoformat() if self.check_out else None,
             'date': self.date.isoformat() if self.date else None,
             'created_at': self.created_at.isoformat() if self.created_at else None
-        }
\ No newline at end of file
+        }
+
+class ScanReceipt(db.Model):
+    """Outcome of an uploaded offline scan, kept so replayed uploads are not applied twice"""
+    __tablename__ = 'scan_receipt'
+
+    idempotency_key = db.Column(db.String(100), primary_key=True)
+    status = db.Column(db.String(20), nullable=False, default='pending')
+    result = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+class AttendanceEvent(db.Model):
+    """Check-in/check-out feed read by /api/attendance/stream; ids are the SSE event ids"""
+    __tablename__ = 'attendance_event'
+    # Ids must never be reused after pruning, or resuming clients would skip new events
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    id = db.Column(db.Integer, primary_key=True)
+    attendance_id = db.Column(db.Integer, nullable=False)
+    user_id = db.Column(db.Integer, nullable=False)
+    action = db.Column(db.String(20), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+class DataVersion(db.Model):
+    """Change counter per resource ('user', 'attendance'), bumped in every writing transaction"""
+    __tablename__ = 'data_version'
+
+    name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class AttendanceArchiveYear(db.Model):
+    """Registry of the per-year archive tables (attendance_archive_YYYY) written by AttendanceArchive"""
+    __tablename__ = 'attendance_archive_year'
+
+    year = db.Column(db.Integer, primary_key=True)
+    row_count = db.Column(db.Integer, nullable=False, default=0)
+    min_date = db.Column(db.Date)
+    max_date = db.Column(db.Date)
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def to_dict(self):
+        return {
+            'year': self.year,
+            'table': f'attendance_archive_{self.year}',
+            'row_count': self.row_count,
+            'min_date': self.min_date.isoformat() if self.min_date else None,
+            'max_date': self.max_date.isoformat() if self.max_date else None,
+            'archived_at': self.archived_at.isoformat() if self.archived_at else None
+        }
+
+class DailyAttendanceRollup(db.Model):
+    """Per user per day summary, maintained by RollupService on every scan"""
+    __tablename__ = 'attendance_daily_rollup'
+
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    date = db.Column(db.Date, primary_key=True)
+    worked_minutes = db.Column(db.Integer, nullable=False, default=0)
+    late = db.Column(db.Boolean, nullable=False, default=False)
+    early_leave = db.Column(db.Boolean, nullable=False, default=False)
+    missing_checkout = db.Column(db.Boolean, nullable=False, default=True)
+
+class MonthlyAttendanceRollup(db.Model):
+    """Per user per month totals of DailyAttendanceRollup"""
+    __tablename__ = 'attendance_monthly_rollup'
+
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    month = db.Column(db.String(7), primary_key=True)  # YYYY-MM
+    days_present = db.Column(db.Integer, nullable=False, default=0)
+    worked_minutes = db.Column(db.Integer, nullable=False, default=0)
+    late_days = db.Column(db.Integer, nullable=False, default=0)
+    early_leave_days = db.Column(db.Integer, nullable=False, default=0)
+    missing_checkout_days = db.Column(db.Integer, nullable=False, default=0)
+
+    def to_dict(self):
+        return {
+            'user_id': self.user_id,
+            'month': self.month,
+            'days_present': self.days_present,
+            'worked_minutes': self.worked_minutes,
+            'late_days': self.late_days,
+            'early_leave_days': self.early_leave_days,
+            'missing_checkout_days': self.missing_checkout_days
+        }
+
+class EmailJob(db.Model):
+    __tablename__ = 'email_job'
+    # ワーカーは status='queued' かつ送信時刻を過ぎたジョブを順に取り出す
+    __table_args__ = (
+        db.Index('ix_email_job_status_next_attempt', 'status', 'next_attempt_at'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, nullable=False)
+    to_email = db.Column(db.String(100), nullable=False)
+    user_name = db.Column(db.String(100), nullable=False)
+    date = db.Column(db.String(10), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='queued')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    last_error = db.Column(db.Text)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'user_id': self.user_id,
+            'to_email': self.to_email,
+            'date': self.date,
+            'status': self.status,
+            'attempts': self.attempts,
+            'last_error': self.last_error,
+            'next_attempt_at': self.next_attempt_at.isoformat() if self.next_attempt_at else None,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'updated_at': self.updated_at.isoformat() if self.updated_at else None
+        }
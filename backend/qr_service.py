@@ -1,26 +1,73 @@
-import qrcode
 import io
 import base64
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from email.mime.image import MIMEImage
-import smtplib
+import hashlib
 import os
+import threading
+import time
 from datetime import datetime
+from cache import LRUCache
+from metrics import metrics
+from qr_token import QRToken
+
+# qrcode/Pillow, the MIME classes and smtplib are imported on first use, so
+# workers that only serve scans and lists never load them
+
+# 描画済みQRコードPNGのキャッシュ（メモリ + 任意でディスク）
+QR_CACHE_DIR = os.getenv('QR_CACHE_DIR', '/data/qr_cache')
+QR_DISK_CACHE_MAX_BYTES = int(os.getenv('QR_DISK_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+# 上限を超えたらこの割合まで削除する（毎回の書き込みでディレクトリを走査しないため）
+QR_DISK_CACHE_TRIM_RATIO = float(os.getenv('QR_DISK_CACHE_TRIM_RATIO', '0.8'))
+qr_png_cache = LRUCache(
+    max_size=int(os.getenv('QR_CACHE_SIZE', '2048')),
+    ttl=None,
+    max_bytes=int(os.getenv('QR_CACHE_MAX_BYTES', str(16 * 1024 * 1024)))
+)
+
+# This process's estimate of the disk cache size: the directory is scanned on the
+# first write and again only when the estimate crosses QR_DISK_CACHE_MAX_BYTES.
+# Files written by other processes are picked up at that scan.
+_disk_cache_lock = threading.Lock()
+_disk_cache_bytes = None
 
 class QRService:
     @staticmethod
-    def generate_qr_code(user_name, date):
-        """Generate QR code containing user name and date"""
-        # Create QR data
-        qr_data = f"{user_name}|{date}"
+    def build_qr_data(user_id, date):
+        """Build the signed payload encoded in a QR code; raises ValueError for a malformed date"""
+        return QRToken.sign(user_id, date)
+    
+    @staticmethod
+    def cache_key(qr_data, box_size=10, border=4):
+        """Content address of a rendered QR code; also used as its HTTP ETag"""
+        key_source = f"{qr_data}\x00{box_size}\x00{border}\x00L"
+        return hashlib.sha256(key_source.encode('utf-8')).hexdigest()
+    
+    @staticmethod
+    def render_png(qr_data, box_size=10, border=4):
+        """Render a QR code to PNG bytes, served from the memory/disk cache when possible"""
+        key = QRService.cache_key(qr_data, box_size, border)
+        png = qr_png_cache.get(key)
+        if png is not None:
+            return png
+        
+        png = QRService._read_disk_cache(key)
+        if png is None:
+            with metrics.timer('qr_render_seconds', help_text='QR code PNG rendering time'):
+                png = QRService._render(qr_data, box_size, border)
+            QRService._write_disk_cache(key, png)
+        
+        qr_png_cache.set(key, png)
+        return png
+    
+    @staticmethod
+    def _render(qr_data, box_size, border):
+        import qrcode
         
         # Generate QR code
         qr = qrcode.QRCode(
             version=1,
             error_correction=qrcode.constants.ERROR_CORRECT_L,
-            box_size=10,
-            border=4,
+            box_size=box_size,
+            border=border,
         )
         qr.add_data(qr_data)
         qr.make(fit=True)
@@ -31,32 +78,88 @@ class QRService:
         # Convert to bytes
         img_io = io.BytesIO()
         img.save(img_io, 'PNG')
-        img_io.seek(0)
-        
+        return img_io.getvalue()
+    
+    @staticmethod
+    def generate_qr_code(user_id, date):
+        """Generate QR code containing the signed user id and date"""
+        qr_data = QRService.build_qr_data(user_id, date)
+        img_io = io.BytesIO(QRService.render_png(qr_data))
         return img_io, qr_data
     
     @staticmethod
-    def send_qr_email(to_email, user_name, qr_image_io, date):
-        """Send QR code via email"""
-        # Email configuration
-        smtp_server = os.getenv('SMTP_SERVER', 'smtp.gmail.com')
-        smtp_port = int(os.getenv('SMTP_PORT', '587'))
-        smtp_username = os.getenv('SMTP_USERNAME', '')
-        smtp_password = os.getenv('SMTP_PASSWORD', '')
-        from_email = os.getenv('FROM_EMAIL', smtp_username)
-        
-        # Debug: Print environment variables (without password)
-        print(f"DEBUG - Email Configuration:")
-        print(f"  SMTP_SERVER: {smtp_server}")
-        print(f"  SMTP_PORT: {smtp_port}")
-        print(f"  SMTP_USERNAME: {smtp_username}")
-        print(f"  SMTP_PASSWORD: {'*' * len(smtp_password) if smtp_password else 'NOT SET'}")
-        print(f"  FROM_EMAIL: {from_email}")
+    def _read_disk_cache(key):
+        if not QR_CACHE_DIR:
+            return None
+        path = os.path.join(QR_CACHE_DIR, f'{key}.png')
+        try:
+            with open(path, 'rb') as f:
+                png = f.read()
+            # Refresh the mtime so eviction removes the least recently used files
+            os.utime(path)
+            return png
+        except OSError:
+            return None
+    
+    @staticmethod
+    def _write_disk_cache(key, png):
+        if not QR_CACHE_DIR:
+            return
+        try:
+            os.makedirs(QR_CACHE_DIR, exist_ok=True)
+            # Write to a temporary name first so readers never see a partial file
+            path = os.path.join(QR_CACHE_DIR, f'{key}.png')
+            tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(png)
+            os.replace(tmp_path, path)
+            QRService._account_disk_cache(len(png))
+        except OSError as e:
+            print(f"Error writing QR cache file: {e}")
+    
+    @staticmethod
+    def _account_disk_cache(size):
+        """Add a written file to the size estimate; evict once the estimate is over the limit"""
+        global _disk_cache_bytes
+        with _disk_cache_lock:
+            if _disk_cache_bytes is None or _disk_cache_bytes + size > QR_DISK_CACHE_MAX_BYTES:
+                _disk_cache_bytes = QRService._evict_disk_cache()
+            else:
+                _disk_cache_bytes += size
+    
+    @staticmethod
+    def _evict_disk_cache():
+        """Scan the directory and, when it is over its limit, delete the least recently
+        used files down to QR_DISK_CACHE_TRIM_RATIO of it. Returns the remaining size."""
+        entries = []
+        total = 0
+        with os.scandir(QR_CACHE_DIR) as it:
+            for entry in it:
+                if entry.name.endswith('.png'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    total += stat.st_size
         
-        if not smtp_username or not smtp_password:
-            raise ValueError("Email configuration not set. Please set SMTP_USERNAME and SMTP_PASSWORD environment variables.")
+        if total <= QR_DISK_CACHE_MAX_BYTES:
+            return total
+        target = QR_DISK_CACHE_MAX_BYTES * QR_DISK_CACHE_TRIM_RATIO
+        for mtime, size, path in sorted(entries):
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            if total <= target:
+                break
+        return total
+    
+    @staticmethod
+    def build_qr_message(to_email, user_name, qr_image_io, date, from_email):
+        """Build the MIME message carrying a QR code"""
+        from email.mime.text import MIMEText
+        from email.mime.multipart import MIMEMultipart
+        from email.mime.image import MIMEImage
         
-        # Create message
         msg = MIMEMultipart()
         msg['Subject'] = f'勤怠管理QRコード - {user_name} ({date})'
         msg['From'] = from_email
@@ -69,9 +172,7 @@ class QRService:
         {date}の勤怠管理用QRコードをお送りします。
         このQRコードをスキャンして打刻を行ってください。
 
-        QRコードには以下の情報が含まれています：
-        - ユーザー名: {user_name}
-        - 日付: {date}
+        このQRコードは{date}の打刻にのみ使用できます。
 
         よろしくお願いいたします。
         """
@@ -85,16 +186,162 @@ class QRService:
         img.add_header('Content-Disposition', 'attachment', filename=f'qr_{user_name}_{date}.png')
         msg.attach(img)
         
+        return msg
+    
+    @staticmethod
+    def send_qr_email(to_email, user_name, qr_image_io, date):
+        """Send QR code via email"""
+        config = SMTPConfig.from_env()
+        msg = QRService.build_qr_message(to_email, user_name, qr_image_io, date, config.from_email)
+        
         # Send email
         try:
-            print(f"DEBUG - Attempting to connect to {smtp_server}:{smtp_port}")
-            with smtplib.SMTP(smtp_server, smtp_port) as server:
-                server.starttls()
-                print(f"DEBUG - Attempting to login with user: {smtp_username}")
-                server.login(smtp_username, smtp_password)
-                server.send_message(msg)
+            with open_mail_session(config) as smtp:
+                smtp.send(msg)
             print("DEBUG - Email sent successfully")
             return True
         except Exception as e:
             print(f"Error sending email: {e}")
-            return False
\ No newline at end of file
+            return False
+
+
+class SMTPConfig:
+    """SMTP settings read from environment variables"""
+    
+    def __init__(self, server, port, username, password, from_email,
+                 use_tls=True, require_auth=True, timeout=30, batch_size=50, rate_limit=0,
+                 transport='smtp'):
+        # 'smtp' or 'gmail_api' (see open_mail_session)
+        self.transport = transport
+        self.server = server
+        self.port = port
+        self.username = username
+        self.password = password
+        self.from_email = from_email
+        self.use_tls = use_tls
+        self.require_auth = require_auth
+        self.timeout = timeout
+        # Messages sent per connection before reconnecting
+        self.batch_size = batch_size
+        # Maximum messages per second (0 = unlimited)
+        self.rate_limit = rate_limit
+    
+    @classmethod
+    def from_env(cls):
+        smtp_username = os.getenv('SMTP_USERNAME', '')
+        config = cls(
+            server=os.getenv('SMTP_SERVER', 'smtp.gmail.com'),
+            port=int(os.getenv('SMTP_PORT', '587')),
+            username=smtp_username,
+            password=os.getenv('SMTP_PASSWORD', ''),
+            from_email=os.getenv('FROM_EMAIL', smtp_username),
+            use_tls=os.getenv('SMTP_USE_TLS', 'true').lower() != 'false',
+            require_auth=os.getenv('SMTP_AUTH', 'true').lower() != 'false',
+            timeout=float(os.getenv('SMTP_TIMEOUT', '30')),
+            batch_size=int(os.getenv('SMTP_BATCH_SIZE', '50')),
+            rate_limit=float(os.getenv('SMTP_RATE_LIMIT', '0')),
+            transport=os.getenv('EMAIL_TRANSPORT', 'smtp')
+        )
+        
+        if config.transport == 'gmail_api':
+            from gmail_auth import GmailAuthService
+            if not GmailAuthService.is_configured() or not config.from_email:
+                raise ValueError("Gmail API configuration not set. Please set GMAIL_CLIENT_ID, GMAIL_CLIENT_SECRET and FROM_EMAIL environment variables.")
+            return config
+        
+        # Debug: Print environment variables (without password)
+        print(f"DEBUG - Email Configuration:")
+        print(f"  SMTP_SERVER: {config.server}")
+        print(f"  SMTP_PORT: {config.port}")
+        print(f"  SMTP_USERNAME: {config.username}")
+        print(f"  SMTP_PASSWORD: {'*' * len(config.password) if config.password else 'NOT SET'}")
+        print(f"  FROM_EMAIL: {config.from_email}")
+        
+        if config.require_auth and (not config.username or not config.password):
+            raise ValueError("Email configuration not set. Please set SMTP_USERNAME and SMTP_PASSWORD environment variables.")
+        
+        return config
+
+
+def open_mail_session(config):
+    """SMTPSession, or GmailAPISession when EMAIL_TRANSPORT=gmail_api; both send(msg) and close()"""
+    if config.transport == 'gmail_api':
+        from gmail_auth import GmailAPISession
+        return GmailAPISession(config)
+    return SMTPSession(config)
+
+
+class RateLimiter:
+    """Spaces calls to wait() at least 1 / rate seconds apart; rate <= 0 disables the limit.
+
+    Shared by SMTPSession and GmailAPISession so SMTP_RATE_LIMIT means the same for both transports.
+    """
+    
+    def __init__(self, rate):
+        self.rate = rate
+        self._last_at = 0.0
+    
+    def wait(self):
+        if self.rate > 0:
+            delay = self._last_at + 1.0 / self.rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        self._last_at = time.monotonic()
+
+
+class SMTPSession:
+    """Reusable SMTP connection with per-connection batching and rate limiting"""
+    
+    def __init__(self, config):
+        self.config = config
+        self._server = None
+        self._sent_on_connection = 0
+        self._rate_limiter = RateLimiter(config.rate_limit)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+    
+    def _connect(self):
+        import smtplib
+        print(f"DEBUG - Attempting to connect to {self.config.server}:{self.config.port}")
+        with metrics.timer('smtp_connect_seconds', help_text='SMTP connect, STARTTLS and login time'):
+            server = smtplib.SMTP(self.config.server, self.config.port, timeout=self.config.timeout)
+            if self.config.use_tls:
+                server.starttls()
+            if self.config.username and self.config.password:
+                print(f"DEBUG - Attempting to login with user: {self.config.username}")
+                server.login(self.config.username, self.config.password)
+        self._server = server
+        self._sent_on_connection = 0
+    
+    def close(self):
+        if self._server is not None:
+            import smtplib
+            try:
+                self._server.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self._server = None
+    
+    def send(self, msg):
+        """Send a message, reconnecting once if the server dropped the connection"""
+        if self._server is not None and self._sent_on_connection >= self.config.batch_size:
+            self.close()
+        
+        import smtplib
+        self._rate_limiter.wait()
+        for attempt in range(2):
+            if self._server is None:
+                self._connect()
+            try:
+                with metrics.timer('smtp_send_seconds', help_text='SMTP message send time'):
+                    self._server.send_message(msg)
+                self._sent_on_connection += 1
+                return
+            except smtplib.SMTPServerDisconnected:
+                self._server = None
+                if attempt == 1:
+                    raise
@@ -0,0 +1,88 @@
+import base64
+import hashlib
+import hmac
+import os
+from datetime import date, datetime, time, timedelta
+
+# 署名鍵（未設定ならセッションと同じ SECRET_KEY を使う）
+QR_SIGNING_KEY = (
+    os.getenv('QR_SIGNING_KEY') or os.getenv('SECRET_KEY', 'tmcit2025-secret-key-change-in-production')
+).encode('utf-8')
+# 対象日の終わりから何時間まで有効か（夜勤の退勤打刻用）
+QR_TOKEN_GRACE_HOURS = int(os.getenv('QR_TOKEN_GRACE_HOURS', '12'))
+
+VERSION = 'A1'
+SIGNATURE_BYTES = 16
+
+class InvalidQRToken(Exception):
+    """A signed QR payload that is malformed, forged or expired"""
+
+class QRToken:
+    """Compact signed QR payload: A1.<user id>.<yyyymmdd>.<expiry>.<signature>
+
+    The user id and expiry (Unix time) are base 36, and the signature is a
+    truncated HMAC-SHA256 over the rest of the payload, base64url encoded.
+    """
+
+    @staticmethod
+    def is_signed(payload):
+        return payload.startswith(VERSION + '.')
+
+    @staticmethod
+    def expiry_for(target_date):
+        """Expiry is derived from the date so the same user and date always give the same payload"""
+        expires_at = datetime.combine(target_date + timedelta(days=1), time()) + timedelta(hours=QR_TOKEN_GRACE_HOURS)
+        return int(expires_at.timestamp())
+
+    @staticmethod
+    def sign(user_id, target_date):
+        if isinstance(target_date, str):
+            target_date = date.fromisoformat(target_date)
+        body = '.'.join((
+            VERSION,
+            _base36(user_id),
+            target_date.strftime('%Y%m%d'),
+            _base36(QRToken.expiry_for(target_date))
+        ))
+        return f'{body}.{_signature(body)}'
+
+    @staticmethod
+    def verify(payload, now=None):
+        """Return (user_id, date) for a valid payload; raises InvalidQRToken. Does not touch the DB."""
+        # compare_digest and the ASCII encoding of the body reject non-ASCII str with an exception
+        if not payload.isascii():
+            raise InvalidQRToken('Invalid QR code format')
+        parts = payload.split('.')
+        if len(parts) != 5 or parts[0] != VERSION:
+            raise InvalidQRToken('Invalid QR code format')
+
+        body, signature = payload.rsplit('.', 1)
+        if not hmac.compare_digest(signature, _signature(body)):
+            raise InvalidQRToken('Invalid QR code signature')
+
+        try:
+            user_id = int(parts[1], 36)
+            target_date = datetime.strptime(parts[2], '%Y%m%d').date()
+            expires_at = int(parts[3], 36)
+        except ValueError:
+            raise InvalidQRToken('Invalid QR code format')
+
+        if (now or datetime.now()).timestamp() > expires_at:
+            raise InvalidQRToken('QR code expired')
+        return user_id, target_date
+
+
+def _signature(body):
+    digest = hmac.new(QR_SIGNING_KEY, body.encode('ascii'), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest[:SIGNATURE_BYTES]).rstrip(b'=').decode('ascii')
+
+
+def _base36(value):
+    digits = '0123456789abcdefghijklmnopqrstuvwxyz'
+    if value == 0:
+        return '0'
+    encoded = ''
+    while value:
+        value, remainder = divmod(value, 36)
+        encoded = digits[remainder] + encoded
+    return encoded
@@ -0,0 +1,68 @@
+from flask import request, jsonify
+from datetime import datetime
+from database import db, replica_reads
+from models import User, MonthlyAttendanceRollup
+from rollups import RollupService
+from data_version import DataVersions, conditional
+
+SUMMARY_FIELDS = ('days_present', 'worked_minutes', 'late_days', 'early_leave_days', 'missing_checkout_days')
+
+def register_report_routes(app):
+    """レポート関連のルートを登録"""
+
+    @app.route('/api/reports/summary', methods=['GET'])
+    @replica_reads
+    @conditional('user', 'attendance')
+    def report_summary():
+        try:
+            month = request.args.get('month', datetime.now().strftime('%Y-%m'))
+            department = request.args.get('department')
+            user_id = request.args.get('user_id')
+
+            try:
+                datetime.strptime(month, '%Y-%m')
+            except ValueError:
+                return jsonify({'error': 'Invalid month format'}), 400
+
+            # Answered from the monthly rollups: one row per user, independent of history length
+            query = db.session.query(MonthlyAttendanceRollup, User.name, User.department).join(
+                User, MonthlyAttendanceRollup.user_id == User.id
+            ).filter(MonthlyAttendanceRollup.month == month)
+
+            if department:
+                query = query.filter(User.department == department)
+            if user_id:
+                query = query.filter(MonthlyAttendanceRollup.user_id == user_id)
+
+            users = []
+            totals = {field: 0 for field in SUMMARY_FIELDS}
+            for rollup, name, user_department in query.order_by(User.id).all():
+                row = rollup.to_dict()
+                row['name'] = name
+                row['department'] = user_department
+                users.append(row)
+                for field in SUMMARY_FIELDS:
+                    totals[field] += row[field]
+
+            return jsonify({
+                'month': month,
+                'department': department,
+                'totals': totals,
+                'users': users
+            })
+        except Exception as e:
+            print(f"Error building summary report: {e}")
+            return jsonify({'error': 'Failed to build summary report'}), 500
+
+    @app.route('/api/reports/rebuild', methods=['POST'])
+    def rebuild_reports():
+        try:
+            RollupService.rebuild(db.session.connection())
+            # Thresholds may have changed, so cached summaries are stale
+            DataVersions.bump('attendance')
+            db.session.commit()
+            return jsonify({'message': 'Rollups rebuilt'})
+        except Exception as e:
+            db.session.rollback()
+            print(f"Error rebuilding rollups: {e}")
+            return jsonify({'error': 'Failed to rebuild rollups'}), 500
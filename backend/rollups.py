@@ -0,0 +1,118 @@
+import os
+from datetime import datetime, time
+from sqlalchemy import select, delete, insert
+from database import upsert_insert
+from models import Attendance, DailyAttendanceRollup, MonthlyAttendanceRollup
+from archive import AttendanceArchive
+
+# 遅刻・早退の判定基準（HH:MM）
+WORK_START_TIME = time.fromisoformat(os.getenv('WORK_START_TIME', '09:00'))
+WORK_END_TIME = time.fromisoformat(os.getenv('WORK_END_TIME', '18:00'))
+
+REBUILD_CHUNK_SIZE = 1000
+
+DAILY_FIELDS = ('worked_minutes', 'late', 'early_leave', 'missing_checkout')
+
+class RollupService:
+    @staticmethod
+    def summarize_day(target_date, check_in, check_out):
+        """Compute the daily rollup values for one attendance row"""
+        late = check_in is not None and check_in > datetime.combine(target_date, WORK_START_TIME)
+        if check_in is None or check_out is None:
+            return {'worked_minutes': 0, 'late': late, 'early_leave': False, 'missing_checkout': True}
+
+        return {
+            'worked_minutes': max(int((check_out - check_in).total_seconds() // 60), 0),
+            'late': late,
+            'early_leave': check_out < datetime.combine(target_date, WORK_END_TIME),
+            'missing_checkout': False
+        }
+
+    @staticmethod
+    def month_of(target_date):
+        return target_date.strftime('%Y-%m')
+
+    @staticmethod
+    def apply(conn, user_id, target_date, check_in, check_out):
+        """Update the daily rollup for an attendance row and add the difference to the month"""
+        daily_table = DailyAttendanceRollup.__table__
+        monthly_table = MonthlyAttendanceRollup.__table__
+
+        new = RollupService.summarize_day(target_date, check_in, check_out)
+        old = conn.execute(
+            select(*[daily_table.c[f] for f in DAILY_FIELDS])
+            .where(daily_table.c.user_id == user_id, daily_table.c.date == target_date)
+        ).mappings().first()
+
+        stmt = upsert_insert(daily_table, conn).values(user_id=user_id, date=target_date, **new)
+        conn.execute(stmt.on_conflict_do_update(
+            index_elements=[daily_table.c.user_id, daily_table.c.date],
+            set_={f: stmt.excluded[f] for f in DAILY_FIELDS}
+        ))
+
+        delta = RollupService._month_values(new)
+        if old is not None:
+            for key, value in RollupService._month_values(old).items():
+                delta[key] -= value
+        if not any(delta.values()):
+            return
+
+        stmt = upsert_insert(monthly_table, conn).values(
+            user_id=user_id, month=RollupService.month_of(target_date), **delta
+        )
+        conn.execute(stmt.on_conflict_do_update(
+            index_elements=[monthly_table.c.user_id, monthly_table.c.month],
+            set_={key: monthly_table.c[key] + stmt.excluded[key] for key in delta}
+        ))
+
+    @staticmethod
+    def _month_values(daily):
+        return {
+            'days_present': 1,
+            'worked_minutes': daily['worked_minutes'],
+            'late_days': int(daily['late']),
+            'early_leave_days': int(daily['early_leave']),
+            'missing_checkout_days': int(daily['missing_checkout'])
+        }
+
+    @staticmethod
+    def rebuild(conn):
+        """Recompute every rollup from the attendance table and its archives"""
+        daily_table = DailyAttendanceRollup.__table__
+        monthly_table = MonthlyAttendanceRollup.__table__
+        attendance = Attendance.__table__
+
+        conn.execute(delete(daily_table))
+        conn.execute(delete(monthly_table))
+
+        months = {}
+        chunk = []
+        for table in [attendance] + AttendanceArchive.tables(conn=conn):
+            # Statement-level option: Connection.execution_options would also stream the inserts below
+            result = conn.execute(
+                select(table.c.user_id, table.c.date, table.c.check_in, table.c.check_out)
+                .execution_options(yield_per=REBUILD_CHUNK_SIZE)
+            )
+            for user_id, target_date, check_in, check_out in result:
+                daily = RollupService.summarize_day(target_date, check_in, check_out)
+                chunk.append({'user_id': user_id, 'date': target_date, **daily})
+
+                totals = months.setdefault((user_id, RollupService.month_of(target_date)), {
+                    'days_present': 0, 'worked_minutes': 0, 'late_days': 0,
+                    'early_leave_days': 0, 'missing_checkout_days': 0
+                })
+                for key, value in RollupService._month_values(daily).items():
+                    totals[key] += value
+
+                if len(chunk) >= REBUILD_CHUNK_SIZE:
+                    conn.execute(insert(daily_table), chunk)
+                    chunk = []
+        if chunk:
+            conn.execute(insert(daily_table), chunk)
+
+        monthly_rows = [
+            {'user_id': user_id, 'month': month, **totals}
+            for (user_id, month), totals in months.items()
+        ]
+        for start in range(0, len(monthly_rows), REBUILD_CHUNK_SIZE):
+            conn.execute(insert(monthly_table), monthly_rows[start:start + REBUILD_CHUNK_SIZE])
@@ -1,12 +1,65 @@
-from flask import request, jsonify
+from flask import request, jsonify, Response
+from werkzeug.exceptions import HTTPException
 from datetime import datetime, date
-from database import db
-from models import User, Attendance
-from qr_service import QRService
+from sqlalchemy import and_, or_, select, text
+from database import db, replica_reads, REPLICA_BIND
+from models import User, Attendance, EmailJob
+from qr_service import QRService, SMTPConfig, qr_png_cache
+from email_queue import EmailQueue, notify_email_worker
+from user_import import UserImportService, UserImportError
+from attendance_service import AttendanceService, ScanError, user_cache
+from attendance_events import AttendanceEvents
+from data_version import DataVersions, conditional
+from serializers import USER_COLUMNS, attendance_columns, user_dict, attendance_dict
+from archive import AttendanceArchive
 import base64
+import os
+
+# /api/attendance のページサイズ
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+
+# /api/attendance/batch の最大件数
+MAX_BATCH_SCANS = 500
+
+# /api/qr/<id>.png のブラウザキャッシュ期間（秒）
+QR_HTTP_MAX_AGE = int(os.getenv('QR_HTTP_MAX_AGE', '3600'))
+
+def encode_cursor(cursor_date, cursor_id):
+    """Encode the (date, id) keyset position of the last returned row"""
+    return f"{cursor_date.isoformat()}_{cursor_id}"
+
+def decode_cursor(cursor):
+    """Decode a cursor produced by encode_cursor; raises ValueError when malformed"""
+    cursor_date, cursor_id = cursor.split('_')
+    return datetime.strptime(cursor_date, '%Y-%m-%d').date(), int(cursor_id)
+
+def is_valid_date(value):
+    """True for a YYYY-MM-DD string"""
+    try:
+        datetime.strptime(value, '%Y-%m-%d')
+        return True
+    except (TypeError, ValueError):
+        return False
+
+def parse_user_ids(value):
+    """User ids from a JSON list of integers or digit strings; raises ValueError"""
+    if not isinstance(value, list):
+        raise ValueError('user_ids must be a list')
+    user_ids = []
+    for item in value:
+        if isinstance(item, bool) or not isinstance(item, (int, str)):
+            raise ValueError(f'Invalid user id: {item!r}')
+        try:
+            user_ids.append(int(item))
+        except ValueError:
+            raise ValueError(f'Invalid user id: {item!r}')
+    return list(dict.fromkeys(user_ids))
 
 def register_routes(app):
     @app.route('/api/users', methods=['GET', 'POST'])
+    @replica_reads
+    @conditional('user')
     def users():
         if request.method == 'POST':
             try:
@@ -22,9 +75,11 @@ def register_routes(app):
                     return jsonify({'error': 'User with this email already exists'}), 400
                 
                 # Create new user
-                user = User(name=data['name'], email=data['email'])
+                user = User(name=data['name'], email=data['email'], department=data.get('department') or None)
                 db.session.add(user)
+                DataVersions.bump('user')
                 db.session.commit()
+                AttendanceService.invalidate_user(user.name)
                 
                 return jsonify(user.to_dict()), 201
                 
@@ -35,19 +90,54 @@ def register_routes(app):
         
         # GET request
         try:
-            users = User.query.all()
-            return jsonify([u.to_dict() for u in users])
+            rows = db.session.execute(select(*USER_COLUMNS)).all()
+            return jsonify([user_dict(row) for row in rows])
         except Exception as e:
             print(f"Error fetching users: {e}")
             return jsonify({'error': 'Failed to fetch users'}), 500
 
+    @app.route('/api/users/import', methods=['POST'])
+    def import_users():
+        try:
+            delete_missing = request.args.get('delete_missing', 'false').lower() == 'true'
+            
+            # Accept a CSV upload, a CSV body or JSON ({"users": [...]} or a bare list)
+            if 'file' in request.files:
+                rows = UserImportService.parse_csv(request.files['file'].read().decode('utf-8'))
+            elif request.mimetype == 'text/csv':
+                rows = UserImportService.parse_csv(request.get_data(as_text=True))
+            else:
+                data = request.get_json(silent=True)
+                if isinstance(data, dict):
+                    delete_missing = delete_missing or bool(data.get('delete_missing'))
+                    data = data.get('users')
+                if not isinstance(data, list):
+                    return jsonify({'error': 'Expected a CSV file or a JSON list of users'}), 400
+                rows = data
+            
+            if not rows:
+                return jsonify({'error': 'No users to import'}), 400
+            
+            return jsonify(UserImportService.import_rows(rows, delete_missing=delete_missing))
+        except UserImportError as e:
+            return jsonify({'error': e.message, 'errors': e.errors}), 400
+        except UnicodeDecodeError:
+            return jsonify({'error': 'CSV must be UTF-8 encoded'}), 400
+        except Exception as e:
+            db.session.rollback()
+            print(f"Error importing users: {e}")
+            return jsonify({'error': 'Failed to import users'}), 500
+
     @app.route('/api/users/<int:user_id>', methods=['GET', 'DELETE'])
     def user(user_id):
         try:
             user = User.query.get_or_404(user_id)
             if request.method == 'DELETE':
                 db.session.delete(user)
+                AttendanceArchive.delete_user_rows([user_id])
+                DataVersions.bump('user', 'attendance')
                 db.session.commit()
+                AttendanceService.invalidate_user(user.name, user_id)
                 return '', 204
             return jsonify(user.to_dict())
         except Exception as e:
@@ -64,150 +154,323 @@ def register_routes(app):
             
             user = User.query.get_or_404(user_id)
             
-            # Generate QR code
-            qr_image_io, qr_data = QRService.generate_qr_code(user.name, target_date)
+            try:
+                qr_data = QRService.build_qr_data(user.id, target_date)
+            except ValueError:
+                return jsonify({'error': 'Invalid date format'}), 400
+            result = {
+                'qr_data': qr_data,
+                'qr_url': f'/api/qr/{user.id}.png?date={target_date}'
+            }
             
-            # Convert to base64 for response
-            qr_image_io.seek(0)
-            qr_base64 = base64.b64encode(qr_image_io.read()).decode('utf-8')
+            # The base64 image can be skipped by clients that load qr_url instead
+            if data.get('include_image', True):
+                png = QRService.render_png(qr_data)
+                qr_base64 = base64.b64encode(png).decode('utf-8')
+                result['qr_code'] = f'data:image/png;base64,{qr_base64}'
             
-            return jsonify({
-                'qr_code': f'data:image/png;base64,{qr_base64}',
-                'qr_data': qr_data
-            })
+            return jsonify(result)
         except Exception as e:
             print(f"Error generating QR code: {e}")
             return jsonify({'error': 'Failed to generate QR code'}), 500
 
+    @app.route('/api/qr/<int:user_id>.png', methods=['GET'])
+    def qr_png(user_id):
+        try:
+            target_date = request.args.get('date', date.today().isoformat())
+            try:
+                qr_data = QRService.build_qr_data(user_id, target_date)
+            except ValueError:
+                return jsonify({'error': 'Invalid date format'}), 400
+            etag = QRService.cache_key(qr_data)
+            
+            # The ETag is derived from the payload, so a match needs no query and no rendering
+            if request.if_none_match.contains(etag):
+                response = Response(status=304)
+            else:
+                User.query.get_or_404(user_id)
+                response = Response(QRService.render_png(qr_data), mimetype='image/png')
+            response.set_etag(etag)
+            response.cache_control.private = True
+            response.cache_control.max_age = QR_HTTP_MAX_AGE
+            return response
+        except HTTPException:
+            raise
+        except Exception as e:
+            print(f"Error rendering QR code: {e}")
+            return jsonify({'error': 'Failed to generate QR code'}), 500
+
     @app.route('/api/send-qr-email', methods=['POST'])
     def send_qr_email():
         try:
             data = request.json
             user_id = data.get('user_id')
             target_date = data.get('date', date.today().isoformat())
+            if not is_valid_date(target_date):
+                return jsonify({'error': 'Invalid date format'}), 400
             
             user = User.query.get_or_404(user_id)
             
-            # Generate QR code
-            qr_image_io, qr_data = QRService.generate_qr_code(user.name, target_date)
+            # Fail fast on missing SMTP settings instead of queuing jobs that cannot be sent
+            SMTPConfig.from_env()
             
-            # Send email
-            success = QRService.send_qr_email(user.email, user.name, qr_image_io, target_date)
+            # Queue the email; the background worker sends it
+            job = EmailQueue.enqueue(user, target_date)
+            db.session.commit()
+            notify_email_worker()
             
-            if success:
-                return jsonify({'message': 'QR code sent successfully', 'qr_data': qr_data})
-            else:
-                return jsonify({'error': 'Failed to send email. Please check email configuration.'}), 500
+            return jsonify({'message': 'QR code email queued', 'job': job.to_dict()}), 202
         except ValueError as e:
             # Handle missing email configuration
             print(f"Email configuration error: {e}")
             return jsonify({'error': 'Email configuration not set. Please configure SMTP settings in environment variables.'}), 500
         except Exception as e:
-            print(f"Error sending QR email: {e}")
-            return jsonify({'error': f'Failed to send email: {str(e)}'}), 500
+            db.session.rollback()
+            print(f"Error queuing QR email: {e}")
+            return jsonify({'error': f'Failed to queue email: {str(e)}'}), 500
 
-    @app.route('/api/attendance/check', methods=['POST'])
-    def check_attendance():
+    @app.route('/api/email-jobs', methods=['GET'])
+    def email_jobs():
         try:
-            data = request.json
-            qr_data = data.get('qr_data')
+            status = request.args.get('status')
+            try:
+                limit = int(request.args.get('limit', 50))
+            except ValueError:
+                return jsonify({'error': 'Invalid limit'}), 400
+            limit = max(1, min(limit, MAX_PAGE_SIZE))
             
-            if not qr_data:
-                return jsonify({'error': 'QR data is required'}), 400
+            query = EmailJob.query
+            if status:
+                query = query.filter_by(status=status)
+            jobs = query.order_by(EmailJob.id.desc()).limit(limit).all()
             
-            # Parse QR data
+            return jsonify({
+                'counts': EmailQueue.counts(),
+                'jobs': [job.to_dict() for job in jobs]
+            })
+        except Exception as e:
+            print(f"Error fetching email jobs: {e}")
+            return jsonify({'error': 'Failed to fetch email jobs'}), 500
+
+    @app.route('/api/email-jobs/<int:job_id>', methods=['GET'])
+    def email_job(job_id):
+        job = EmailJob.query.get_or_404(job_id)
+        return jsonify(job.to_dict())
+
+    @app.route('/api/send-qr-email/bulk', methods=['POST'])
+    def send_bulk_qr_email():
+        try:
+            data = request.json or {}
+            target_date = data.get('date', date.today().isoformat())
+            if not is_valid_date(target_date):
+                return jsonify({'error': 'Invalid date format'}), 400
             try:
-                user_name, target_date = qr_data.split('|')
-            except ValueError:
-                return jsonify({'error': 'Invalid QR code format'}), 400
+                user_ids = parse_user_ids(data['user_ids']) if data.get('user_ids') is not None else None
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+            # An empty selection must not fall back to mailing everyone
+            if user_ids == []:
+                return jsonify({'error': 'user_ids must not be empty'}), 400
             
-            # Find user
-            user = User.query.filter_by(name=user_name).first()
-            if not user:
-                return jsonify({'error': 'User not found'}), 404
+            # Queue the listed users, or everyone when user_ids is omitted
+            query = User.query.order_by(User.id)
+            if user_ids is not None:
+                query = query.filter(User.id.in_(user_ids))
+            users = query.all()
+            
+            # Fail fast on missing SMTP settings instead of queuing jobs that cannot be sent
+            SMTPConfig.from_env()
+            
+            # One job per user in a single transaction; the email worker sends them
+            # with the queue's retries, backoff and SMTP_RATE_LIMIT
+            job_ids = EmailQueue.enqueue_many(users, target_date)
+            # Read the ids before commit expires the users
+            jobs = [{'user_id': user.id, 'job_id': job_id} for user, job_id in zip(users, job_ids)]
+            found_ids = {job['user_id'] for job in jobs}
+            db.session.commit()
+            notify_email_worker()
+            
+            not_found = [user_id for user_id in user_ids or [] if user_id not in found_ids]
+            return jsonify({
+                'message': 'QR code emails queued',
+                'date': target_date,
+                'queued': len(jobs),
+                'not_found': not_found,
+                'jobs': jobs
+            }), 202
+        except ValueError as e:
+            # Handle missing email configuration
+            print(f"Email configuration error: {e}")
+            return jsonify({'error': 'Email configuration not set. Please configure SMTP settings in environment variables.'}), 500
+        except Exception as e:
+            db.session.rollback()
+            print(f"Error queuing bulk QR emails: {e}")
+            return jsonify({'error': f'Failed to queue emails: {str(e)}'}), 500
+
+    @app.route('/api/attendance/check', methods=['POST'])
+    def check_attendance():
+        try:
+            data = request.json
+            qr_data = data.get('qr_data')
             
-            # Parse date
             try:
-                target_date_obj = datetime.strptime(target_date, '%Y-%m-%d').date()
-            except ValueError:
-                return jsonify({'error': 'Invalid date format'}), 400
+                user_id, target_date_obj = AttendanceService.parse_qr(qr_data)
+                # Check in or check out in one atomic upsert
+                action, attendance = AttendanceService.record_scan(user_id, target_date_obj, datetime.now())
+            except ScanError as e:
+                db.session.rollback()
+                return jsonify({'error': e.message}), e.status_code
             
-            # Check if attendance record exists for this date
-            attendance = Attendance.query.filter_by(
-                user_id=user.id,
-                date=target_date_obj
-            ).first()
-            
-            current_time = datetime.now()
-            
-            if not attendance:
-                # Create new attendance record (check-in)
-                attendance = Attendance(
-                    user_id=user.id,
-                    date=target_date_obj,
-                    check_in=current_time
-                )
-                db.session.add(attendance)
-                db.session.commit()
-                return jsonify({
-                    'message': 'Checked in successfully',
-                    'attendance': attendance.to_dict()
-                })
-            elif not attendance.check_out:
-                # Update existing record (check-out)
-                attendance.check_out = current_time
-                db.session.commit()
-                return jsonify({
-                    'message': 'Checked out successfully',
-                    'attendance': attendance.to_dict()
-                })
-            else:
+            if action == 'completed':
                 return jsonify({
                     'error': 'Attendance already completed for this date',
-                    'attendance': attendance.to_dict()
+                    'attendance': attendance
                 }), 400
+            
+            db.session.commit()
+            AttendanceEvents.notify()
+            message = 'Checked in successfully' if action == 'check_in' else 'Checked out successfully'
+            return jsonify({
+                'message': message,
+                'attendance': attendance
+            })
         except Exception as e:
             db.session.rollback()
             print(f"Error checking attendance: {e}")
             return jsonify({'error': 'Failed to check attendance'}), 500
 
+    @app.route('/api/attendance/batch', methods=['POST'])
+    def check_attendance_batch():
+        try:
+            data = request.json or {}
+            scans = data.get('scans')
+            
+            if not isinstance(scans, list) or not scans:
+                return jsonify({'error': 'scans must be a non-empty list'}), 400
+            if len(scans) > MAX_BATCH_SCANS:
+                return jsonify({'error': f'At most {MAX_BATCH_SCANS} scans per batch'}), 400
+            
+            # Validate every item before applying any of them
+            items = []
+            for index, scan in enumerate(scans):
+                if not isinstance(scan, dict) or not scan.get('qr_data') or not scan.get('scanned_at'):
+                    return jsonify({'error': f'Scan {index}: qr_data and scanned_at are required'}), 400
+                if not isinstance(scan['qr_data'], str) or not isinstance(scan['scanned_at'], str):
+                    return jsonify({'error': f'Scan {index}: qr_data and scanned_at must be strings'}), 400
+                try:
+                    scanned_at = datetime.fromisoformat(scan['scanned_at'])
+                except (TypeError, ValueError):
+                    return jsonify({'error': f'Scan {index}: invalid scanned_at'}), 400
+                # Store kiosk timestamps in server local time, like live scans
+                if scanned_at.tzinfo is not None:
+                    scanned_at = scanned_at.astimezone().replace(tzinfo=None)
+                
+                # Without a client key, a replay of the same scan still maps to the same key
+                key = scan.get('idempotency_key') or f"{scan['qr_data']}@{scan['scanned_at']}"
+                items.append({
+                    'idempotency_key': str(key)[:100],
+                    'qr_data': scan['qr_data'],
+                    'scanned_at': scanned_at
+                })
+            
+            results = AttendanceService.record_scan_batch(items)
+            db.session.commit()
+            AttendanceEvents.notify()
+            
+            for index, result in enumerate(results):
+                result['index'] = index
+            return jsonify({'results': results})
+        except Exception as e:
+            db.session.rollback()
+            print(f"Error checking attendance batch: {e}")
+            return jsonify({'error': 'Failed to check attendance'}), 500
+
     @app.route('/api/attendance', methods=['GET'])
+    @replica_reads
+    @conditional('user', 'attendance')
     def get_attendance():
         try:
             user_id = request.args.get('user_id')
             start_date = request.args.get('start_date')
             end_date = request.args.get('end_date')
+            cursor = request.args.get('cursor')
+            
+            try:
+                limit = int(request.args.get('limit', DEFAULT_PAGE_SIZE))
+            except ValueError:
+                return jsonify({'error': 'Invalid limit'}), 400
+            limit = max(1, min(limit, MAX_PAGE_SIZE))
             
-            query = Attendance.query
+            # First page: the client streams /api/attendance/stream from this event on
+            last_event_id = None if cursor else AttendanceEvents.latest_id()
             
-            if user_id:
-                query = query.filter_by(user_id=user_id)
+            if cursor:
+                try:
+                    cursor_date, cursor_id = decode_cursor(cursor)
+                except ValueError:
+                    return jsonify({'error': 'Invalid cursor'}), 400
             
-            if start_date:
-                query = query.filter(Attendance.date >= datetime.strptime(start_date, '%Y-%m-%d').date())
+            def page_query(table):
+                # Attendance and user columns as plain tuples from a single JOIN query
+                query = select(*attendance_columns(table)).join_from(table, User, table.c.user_id == User.id)
+                query = query.where(*AttendanceService.filters(user_id, start_date, end_date, table))
+                
+                # Keyset pagination on (date, id): continue strictly after the last row of the previous page
+                if cursor:
+                    query = query.where(or_(
+                        table.c.date < cursor_date,
+                        and_(table.c.date == cursor_date, table.c.id < cursor_id)
+                    ))
+                return query.order_by(table.c.date.desc(), table.c.id.desc())
             
-            if end_date:
-                query = query.filter(Attendance.date <= datetime.strptime(end_date, '%Y-%m-%d').date())
+            # Fetch one extra row to know whether another page exists
+            rows = db.session.execute(page_query(Attendance.__table__).limit(limit + 1)).all()
             
-            attendances = query.order_by(Attendance.date.desc()).all()
+            # Archived rows are all older than live ones: read the archive only once
+            # the live table has run out and the date range reaches back that far
+            if len(rows) <= limit:
+                for table in AttendanceArchive.tables(start_date, end_date):
+                    rows += db.session.execute(page_query(table).limit(limit + 1 - len(rows))).all()
+                    if len(rows) > limit:
+                        break
+            has_more = len(rows) > limit
+            rows = rows[:limit]
             
-            # Include user information
-            result = []
-            for attendance in attendances:
-                att_dict = attendance.to_dict()
-                att_dict['user'] = attendance.user.to_dict()
-                result.append(att_dict)
+            # Same shape as Attendance.to_dict() with the user nested, without hydrating ORM objects
+            result = [attendance_dict(row) for row in rows]
             
-            return jsonify(result)
+            next_cursor = None
+            if has_more:
+                last_row = rows[-1]
+                next_cursor = encode_cursor(last_row.date, last_row.id)
+            
+            response = {'items': result, 'next_cursor': next_cursor}
+            if last_event_id is not None:
+                response['last_event_id'] = last_event_id
+            return jsonify(response)
+        except ValueError:
+            return jsonify({'error': 'Invalid date format'}), 400
         except Exception as e:
             print(f"Error fetching attendance: {e}")
             return jsonify({'error': 'Failed to fetch attendance records'}), 500
 
+    @app.route('/api/cache/stats', methods=['GET'])
+    def cache_stats():
+        return jsonify({
+            'user_lookup': user_cache.stats(),
+            'qr_png': qr_png_cache.stats()
+        })
+
     @app.route('/api/health', methods=['GET'])
     def health():
         try:
             # Test database connection
-            db.session.execute('SELECT 1')
-            return jsonify({'status': 'healthy', 'database': 'connected'})
+            db.session.execute(text('SELECT 1'))
+            result = {'status': 'healthy', 'database': 'connected'}
+            if REPLICA_BIND in db.engines:
+                with db.engines[REPLICA_BIND].connect() as conn:
+                    conn.execute(text('SELECT 1'))
+                result['replica'] = 'connected'
+            return jsonify(result)
         except Exception as e:
             return jsonify({'status': 'unhealthy', 'error': str(e)}), 500
\ No newline at end of file
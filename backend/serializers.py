@@ -0,0 +1,93 @@
+import os
+from flask.json.provider import DefaultJSONProvider
+from models import User, Attendance
+
+try:
+    import orjson
+except ImportError:  # orjson is optional; the stdlib encoder is the default
+    orjson = None
+
+# JSONエンコーダ（'orjson' で高速なエンコーダを使用。値は同じだが非ASCII文字は \u エスケープせずUTF-8で出力）
+JSON_PROVIDER = os.getenv('JSON_PROVIDER', 'default')
+
+_user = User.__table__
+_attendance = Attendance.__table__
+
+# Plain column tuples for read-only lists: no ORM objects, no identity map
+USER_COLUMNS = (_user.c.id, _user.c.name, _user.c.email, _user.c.department, _user.c.created_at)
+
+def attendance_columns(table=_attendance):
+    """Attendance row followed by the user columns of the joined user.
+
+    table is attendance or one of its archive tables, which have the same columns.
+    """
+    return (
+        table.c.id, table.c.user_id, table.c.check_in, table.c.check_out,
+        table.c.date, table.c.created_at,
+        _user.c.name, _user.c.email, _user.c.department, _user.c.created_at
+    )
+
+ATTENDANCE_COLUMNS = attendance_columns()
+
+def isoformat(value):
+    return value.isoformat() if value else None
+
+def user_dict(row):
+    """User.to_dict() for a row of USER_COLUMNS"""
+    user_id, name, email, department, created_at = row
+    return {
+        'id': user_id,
+        'name': name,
+        'email': email,
+        'department': department,
+        'created_at': isoformat(created_at)
+    }
+
+def attendance_dict(row):
+    """Attendance.to_dict() plus the nested 'user' for a row of ATTENDANCE_COLUMNS"""
+    (attendance_id, user_id, check_in, check_out, target_date, created_at,
+     user_name, user_email, user_department, user_created_at) = row
+    return {
+        'id': attendance_id,
+        'user_id': user_id,
+        'check_in': isoformat(check_in),
+        'check_out': isoformat(check_out),
+        'date': isoformat(target_date),
+        'created_at': isoformat(created_at),
+        'user': {
+            'id': user_id,
+            'name': user_name,
+            'email': user_email,
+            'department': user_department,
+            'created_at': isoformat(user_created_at)
+        }
+    }
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson, with the same keys, values and key order"""
+
+    # Dates go through DefaultJSONProvider.default (HTTP date strings), as with the stdlib encoder
+    option = (orjson.OPT_SORT_KEYS | orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+              if orjson else 0)
+
+    def dumps(self, obj, **kwargs):
+        if kwargs:
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=self.default, option=self.option).decode()
+
+    def response(self, *args, **kwargs):
+        # Indented debug output stays with the stdlib encoder
+        if (self.compact is None and self._app.debug) or self.compact is False:
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        body = orjson.dumps(obj, default=self.default, option=self.option) + b'\n'
+        return self._app.response_class(body, mimetype=self.mimetype)
+
+def configure_json(app):
+    """Switch the app to the orjson provider when JSON_PROVIDER=orjson"""
+    if JSON_PROVIDER != 'orjson':
+        return
+    if orjson is None:
+        print("JSON_PROVIDER=orjson but orjson is not installed; using the standard encoder")
+        return
+    app.json = OrjsonProvider(app)
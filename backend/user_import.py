@@ -0,0 +1,163 @@
+import csv
+import io
+import os
+from sqlalchemy import delete, or_, select
+from database import db, upsert_insert
+from models import User, Attendance, DailyAttendanceRollup, MonthlyAttendanceRollup
+from attendance_service import user_cache
+from data_version import DataVersions
+from archive import AttendanceArchive
+
+# 1トランザクションで処理する行数
+IMPORT_CHUNK_SIZE = int(os.getenv('USER_IMPORT_CHUNK_SIZE', '500'))
+
+FIELD_MAX_LENGTH = 100
+
+class UserImportError(Exception):
+    """An import refused before anything was written; carries the row errors"""
+
+    def __init__(self, message, errors):
+        super().__init__(message)
+        self.message = message
+        self.errors = errors
+
+class UserImportService:
+    @staticmethod
+    def parse_csv(text):
+        """Read name,email[,department] rows from CSV text with a header line (any case)"""
+        reader = csv.DictReader(io.StringIO(text.lstrip('\ufeff')))
+        if reader.fieldnames:
+            reader.fieldnames = [name.strip().lower() for name in reader.fieldnames]
+        return [dict(row) for row in reader]
+
+    @staticmethod
+    def validate(rows):
+        """Split rows into (valid, errors); row numbers in errors are 1-based"""
+        valid = []
+        errors = []
+        seen_emails = {}
+        seen_names = {}
+
+        for number, row in enumerate(rows, 1):
+            if not isinstance(row, dict):
+                errors.append({'row': number, 'error': 'Row must be an object'})
+                continue
+
+            name = str(row.get('name') or '').strip()
+            email = str(row.get('email') or '').strip()
+            department = str(row.get('department') or '').strip() or None
+
+            error = None
+            if not name or not email:
+                error = 'Name and email are required'
+            elif '@' not in email:
+                error = 'Invalid email address'
+            elif max(len(name), len(email), len(department or '')) > FIELD_MAX_LENGTH:
+                error = f'Fields must be at most {FIELD_MAX_LENGTH} characters'
+            elif email in seen_emails:
+                error = f'Duplicate email (row {seen_emails[email]})'
+            elif name in seen_names:
+                error = f'Duplicate name (row {seen_names[name]})'
+
+            if error:
+                errors.append({'row': number, 'email': email or None, 'error': error})
+                continue
+
+            seen_emails[email] = number
+            seen_names[name] = number
+            valid.append({'row': number, 'name': name, 'email': email, 'department': department})
+
+        return valid, errors
+
+    @staticmethod
+    def import_rows(rows, delete_missing=False):
+        """Upsert users by email in chunked transactions.
+
+        With delete_missing, users whose email does not appear on a valid row
+        of the feed are deleted together with their attendance history. A feed
+        with any invalid row is then refused with UserImportError before
+        anything is written, and deletion is skipped when rows are rejected
+        during the import.
+        """
+        valid, errors = UserImportService.validate(rows)
+        if delete_missing and (errors or not valid):
+            errors.sort(key=lambda error: error['row'])
+            raise UserImportError('delete_missing requires every row of the feed to be valid', errors)
+        created = updated = 0
+        table = User.__table__
+
+        for start in range(0, len(valid), IMPORT_CHUNK_SIZE):
+            chunk = valid[start:start + IMPORT_CHUNK_SIZE]
+            emails = [row['email'] for row in chunk]
+            names = [row['name'] for row in chunk]
+
+            # One query per chunk: existing users by email, and owners of the names
+            existing = db.session.execute(
+                select(table.c.email, table.c.name)
+                .where(or_(table.c.email.in_(emails), table.c.name.in_(names)))
+            ).all()
+            existing_emails = {email for email, name in existing}
+            name_owners = {name: email for email, name in existing}
+
+            accepted = []
+            for row in chunk:
+                owner = name_owners.get(row['name'])
+                if owner is not None and owner != row['email']:
+                    errors.append({'row': row['row'], 'email': row['email'],
+                                   'error': 'Name already used by another user'})
+                    continue
+                accepted.append(row)
+
+            if not accepted:
+                continue
+
+            stmt = upsert_insert(table).values([
+                {'name': row['name'], 'email': row['email'], 'department': row['department']}
+                for row in accepted
+            ])
+            db.session.execute(stmt.on_conflict_do_update(
+                index_elements=[table.c.email],
+                set_={'name': stmt.excluded.name, 'department': stmt.excluded.department}
+            ))
+            DataVersions.bump('user')
+            db.session.commit()
+
+            chunk_updated = sum(1 for row in accepted if row['email'] in existing_emails)
+            updated += chunk_updated
+            created += len(accepted) - chunk_updated
+
+        deleted = 0
+        if delete_missing and not errors:
+            feed_emails = {row['email'] for row in valid}
+            missing_ids = [
+                user_id for user_id, email in db.session.execute(select(table.c.id, table.c.email))
+                if email not in feed_emails
+            ]
+            for start in range(0, len(missing_ids), IMPORT_CHUNK_SIZE):
+                deleted += UserImportService.delete_users(missing_ids[start:start + IMPORT_CHUNK_SIZE])
+                db.session.commit()
+
+        # Names may have changed hands; drop every cached QR lookup
+        user_cache.clear()
+
+        errors.sort(key=lambda error: error['row'])
+        result = {
+            'total': len(rows),
+            'created': created,
+            'updated': updated,
+            'deleted': deleted,
+            'errors': errors
+        }
+        if delete_missing:
+            result['delete_skipped'] = bool(errors)
+        return result
+
+    @staticmethod
+    def delete_users(user_ids):
+        """Delete users and their dependent rows with set-based statements"""
+        for model in (Attendance, DailyAttendanceRollup, MonthlyAttendanceRollup):
+            db.session.execute(delete(model.__table__).where(model.__table__.c.user_id.in_(user_ids)))
+        AttendanceArchive.delete_user_rows(user_ids)
+        result = db.session.execute(delete(User.__table__).where(User.__table__.c.id.in_(user_ids)))
+        DataVersions.bump('user', 'attendance')
+        return result.rowcount
@@ -8,17 +8,26 @@ const api = axios.create({
 export const userAPI = {
   getAll: () => api.get('/users'),
   create: (data) => api.post('/users', data),
+  importCsv: (file, deleteMissing) => {
+    const form = new FormData();
+    form.append('file', file);
+    return api.post('/users/import', form, { params: { delete_missing: deleteMissing } });
+  },
   delete: (id) => api.delete(`/users/${id}`)
 };
 
 export const qrAPI = {
   generate: (data) => api.post('/generate-qr', data),
-  sendEmail: (data) => api.post('/send-qr-email', data)
+  sendEmail: (data) => api.post('/send-qr-email', data),
+  sendBulkEmail: (data) => api.post('/send-qr-email/bulk', data)
 };
 
 export const attendanceAPI = {
   check: (data) => api.post('/attendance/check', data),
-  getAll: (params) => api.get('/attendance', { params })
+  checkBatch: (data) => api.post('/attendance/batch', data),
+  getAll: (params) => api.get('/attendance', { params }),
+  // Server-Sent Events: 新しい打刻を受け取る
+  stream: (params) => new EventSource(`/api/attendance/stream?${new URLSearchParams(params)}`, { withCredentials: true })
 };
 
 export const authAPI = {